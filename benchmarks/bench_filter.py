@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2024 Carnegie Mellon University
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+"""Compare the Datumaro XPath filters with the native tpod-filter transform
+
+Usage: python benchmarks/bench_filter.py [-n 100000] [--annotations 5]
+
+A synthetic dataset with occluded and visible boxes, and frames without
+annotations, is filtered both ways and the results are checked to be equal.
+"""
+
+import argparse
+import time
+
+import datumaro as dm
+import numpy as np
+
+from opentpod_tools.filter import AnnotationFilterTransform, attribute_equals
+
+
+def synthetic_items(count, annotations):
+    rng = np.random.default_rng(0)
+    for i in range(count):
+        boxes = [
+            dm.Bbox(
+                *rng.uniform(0, 500, 4),
+                label=int(rng.integers(0, 3)),
+                attributes={"occluded": bool(rng.random() < 0.3)},
+            )
+            for _ in range(int(rng.integers(0, annotations + 1)))
+        ]
+        yield dm.DatasetItem(id=f"frame_{i:06d}", annotations=boxes)
+
+
+def synthetic_dataset(count, annotations):
+    return dm.Dataset.from_iterable(
+        synthetic_items(count, annotations), categories=["car", "person", "sign"]
+    )
+
+
+def xpath_filter(dataset):
+    dataset = dataset.filter(
+        '/item/annotation[occluded="False"]', filter_annotations=True, remove_empty=True
+    )
+    return dataset.filter("//*", filter_annotations=True, remove_empty=True)
+
+
+def native_filter(dataset):
+    return dataset.transform(
+        AnnotationFilterTransform, predicates=[attribute_equals("occluded", "False")]
+    )
+
+
+def timed(function, dataset):
+    start = time.perf_counter()
+    result = [(item.id, item.annotations) for item in function(dataset)]
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--items", type=int, default=100000)
+    parser.add_argument("--annotations", type=int, default=5, help="per item (max)")
+    args = parser.parse_args()
+
+    # both filters modify the dataset in place, so each gets a fresh copy
+    xpath, expected = timed(
+        xpath_filter, synthetic_dataset(args.items, args.annotations)
+    )
+    native, result = timed(
+        native_filter, synthetic_dataset(args.items, args.annotations)
+    )
+    assert result == expected, "native filter output differs from XPath filters"
+
+    print(f"items:         {args.items} ({len(result)} kept)")
+    print(f"xpath filters: {xpath:8.2f} s")
+    print(f"native filter: {native:8.2f} s")
+    print(f"speedup:       {xpath / native:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
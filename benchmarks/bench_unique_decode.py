@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2024 Carnegie Mellon University
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+"""Compare per-frame hashing cost of full and reduced resolution decoding
+
+Usage: python benchmarks/bench_unique_decode.py [--size 1920x1080] [image ...]
+
+Without image arguments a set of synthetic JPEG frames is generated.
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from opentpod_tools.unique import _hash_image_source
+
+
+def synthetic_frames(directory, count, size):
+    rng = np.random.default_rng(0)
+    width, height = size
+    paths = []
+    for i in range(count):
+        # low frequency noise compresses like natural images do
+        noise = rng.integers(0, 256, (height // 16, width // 16, 3), dtype=np.uint8)
+        frame = Image.fromarray(noise).resize((width, height), Image.BILINEAR)
+        path = Path(directory, f"frame_{i:04d}.jpg")
+        frame.save(path, quality=90)
+        paths.append(str(path))
+    return paths
+
+
+def time_per_frame(paths, reduced_decode):
+    start = time.perf_counter()
+    for path in paths:
+        _hash_image_source(path, reduced_decode=reduced_decode)
+    return (time.perf_counter() - start) / len(paths)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--frames", type=int, default=50)
+    parser.add_argument("--size", default="1920x1080", help="synthetic frame size")
+    parser.add_argument("images", nargs="*", help="benchmark these images instead")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = args.images
+        if not paths:
+            size = tuple(int(dim) for dim in args.size.split("x"))
+            paths = synthetic_frames(tmpdir, args.frames, size)
+
+        # warm up the page cache so both runs only measure decoding
+        time_per_frame(paths, reduced_decode=True)
+
+        full = time_per_frame(paths, reduced_decode=False)
+        reduced = time_per_frame(paths, reduced_decode=True)
+
+    print(f"frames:          {len(paths)}")
+    print(f"full decode:     {full * 1000:8.2f} ms/frame")
+    print(f"reduced decode:  {reduced * 1000:8.2f} ms/frame")
+    print(f"speedup:         {full / reduced:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
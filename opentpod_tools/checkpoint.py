@@ -0,0 +1,93 @@
+# SPDX-FileCopyrightText: 2024 Carnegie Mellon University
+# SPDX-License-Identifier: Apache-2.0
+
+"""Checkpoints of per-item results to resume interrupted dataset processing"""
+
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+from typing import Any
+
+# number of new entries written before the checkpoint is synced to disk
+CHECKPOINT_INTERVAL = 1000
+
+
+def checkpoint_path(output: Path) -> Path:
+    """Default checkpoint file for an output dataset"""
+    return output.with_name(f"{output.name}.checkpoint.jsonl")
+
+
+class Checkpoint:
+    """Append-only JSON lines log of the results for processed dataset items.
+
+    The first line holds the configuration of the run, followed by one
+    [id, subset, result] line per item. Resuming only accepts a checkpoint
+    with the same configuration, and ignores a partially written last line
+    left behind when the process was killed.
+    """
+
+    def __init__(self, path: Path | str, config: dict, resume: bool = False):
+        self.path = Path(path)
+        self._results: dict[tuple[str, str], Any] = {}
+
+        if resume and self.path.exists():
+            valid_size = self._load(config)
+            self._file = self.path.open("r+")
+            self._file.truncate(valid_size)
+            self._file.seek(valid_size)
+        else:
+            self._file = self.path.open("w")
+            self._file.write(json.dumps(config) + "\n")
+        self._pending = 0
+
+    def _load(self, config: dict) -> int:
+        with self.path.open("rb") as checkpoint:
+            header = checkpoint.readline()
+            # compare after a round trip through JSON, i.e. tuples become lists
+            expected = json.loads(json.dumps(config))
+            if not header.endswith(b"\n") or json.loads(header) != expected:
+                raise ValueError(
+                    f"{self.path} was created for a different dataset or options"
+                )
+            valid_size = checkpoint.tell()
+
+            for line in iter(checkpoint.readline, b""):
+                if not line.endswith(b"\n"):
+                    break
+                item_id, subset, result = json.loads(line)
+                self._results[item_id, subset] = result
+                valid_size = checkpoint.tell()
+        return valid_size
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    def __contains__(self, key: tuple[str, str]) -> bool:
+        return key in self._results
+
+    def get(self, key: tuple[str, str], default: Any = None) -> Any:
+        return self._results.get(key, default)
+
+    def put(self, key: tuple[str, str], result: Any) -> None:
+        self._results[key] = result
+        self._file.write(json.dumps([*key, result]) + "\n")
+        self._pending += 1
+        if self._pending >= CHECKPOINT_INTERVAL:
+            self.flush()
+
+    def flush(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def remove(self) -> None:
+        """Delete the checkpoint once the output has been saved"""
+        self.close()
+        self.path.unlink()
@@ -8,129 +8,597 @@
 """Download datasets from one or more CVAT tasks.
 """
 
+import asyncio
+import hashlib
+import json
 import os
+import re
+import shutil
+import threading
 import time
 import zipfile
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from functools import partial
 from pathlib import Path
 from urllib.parse import urljoin
 
 import configargparse
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
 from tqdm.auto import tqdm
+from urllib3.util.retry import Retry
+
+# delays between polls while CVAT prepares an export, in seconds
+POLL_INITIAL = 1.0
+POLL_MAX = 30.0
+POLL_BACKOFF = 2.0
+
+# attempts to complete a download when the connection drops
+DOWNLOAD_ATTEMPTS = 3
+
+# maximum number of exports and downloads in progress at the same time
+MAX_CONCURRENCY = 4
+
+# retries of failed connections and server errors, with increasing delays
+RETRIES = 5
+RETRY_BACKOFF = 0.5
+RETRY_STATUS = (500, 502, 503, 504)
+
+# record of the downloaded datasets used by --sync
+DEFAULT_MANIFEST = Path("tpod-download-manifest.json")
+
+# size of the chunks read from the network and written to disk
+CHUNK_SIZE = 1024 * 1024
+
+DATASET_FORMATS = {
+    "datumaro": "Datumaro 1.0",
+    "coco": "COCO 1.0",
+    "pascal": "PASCAL VOC 1.1",
+    "labelme": "LabelMe 3.0",
+    "mask": "Segmentation mask 1.1",
+    "mot": "MOT 1.1",
+    "tfrecord": "TFRecord 1.0",
+    "yolo": "YOLO 1.1",
+}
+
+
+def poll_delays(initial=POLL_INITIAL, maximum=POLL_MAX, backoff=POLL_BACKOFF):
+    """Exponentially increasing delays between polls, capped at maximum"""
+    delay = initial
+    while True:
+        yield delay
+        delay = min(delay * backoff, maximum)
+
+
+class DiskUsage:
+    """Thread-safe tally of the bytes written by downloads and extraction"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    def update(self, delta):
+        with self._lock:
+            self.current += delta
+            self.peak = max(self.peak, self.current)
+
+
+def part_path(output):
+    """Temporary file an export is downloaded to before it is complete"""
+    output = Path(output)
+    return output.with_name(f"{output.name}.part")
+
+
+def _validator_path(part):
+    """ETag or Last-Modified of the export a partial download belongs to"""
+    return part.with_name(f"{part.name}.validator")
+
+
+def _part_size(part):
+    try:
+        return os.path.getsize(part)
+    except FileNotFoundError:
+        return 0
+
+
+def _remove_part(part):
+    """Discard a partial download and its validator"""
+    for path in (part, _validator_path(part)):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def _read_validator(part):
+    try:
+        return _validator_path(part).read_text()
+    except FileNotFoundError:
+        return None
+
+
+def _write_validator(part, response):
+    """Remember which export a new partial download belongs to, only a
+    strong ETag or a Last-Modified date can be used with If-Range"""
+    etag = response.headers.get("ETag")
+    if etag is not None and not etag.startswith("W/"):
+        validator = etag
+    else:
+        validator = response.headers.get("Last-Modified")
+
+    if validator is not None:
+        _validator_path(part).write_text(validator)
+    else:
+        _validator_path(part).unlink(missing_ok=True)
+
+
+def _export_request(session, url, params, part=None):
+    """Request an export, returns the streaming response once the exported
+    dataset is ready for download, or None while it is being prepared.
+
+    When a partial download exists, only the remaining bytes are requested.
+    The request is conditional on the export being unchanged (If-Range), so
+    the server sends the complete new export otherwise. A partial download
+    without a validator cannot be checked and is discarded.
+    """
+    offset = _part_size(part) if part is not None else 0
+    validator = _read_validator(part) if offset else None
+    if offset and validator is None:
+        _remove_part(part)
+        offset = 0
+    headers = {"Range": f"bytes={offset}-", "If-Range": validator} if offset else None
+
+    response = session.get(url, params=params, headers=headers, stream=True)
+    if response.status_code == 416:
+        # the partial download is not part of the current export
+        response.close()
+        _remove_part(part)
+        return _export_request(session, url, params)
+
+    try:
+        response.raise_for_status()
+        if response.status_code not in (200, 206):
+            # read the (empty) body so the connection goes back to the pool
+            response.content
+            response.close()
+            return None
+        if response.headers["Content-Type"] != "application/zip":
+            raise RequestException("Unexpected response content type")
+    except Exception:
+        response.close()
+        raise
+    return response
+
+
+def _resume_offset(response, part):
+    """Offset in the partial download where the response data starts"""
+    if response.status_code != 206:
+        return 0
+
+    match = re.fullmatch(
+        r"bytes (\d+)-\d+/(\d+|\*)", response.headers.get("Content-Range", "")
+    )
+    if match is None or int(match[1]) != _part_size(part):
+        # we can't tell where this data belongs, start over on the next attempt
+        _remove_part(part)
+        raise RequestException("Unexpected Content-Range in response")
+    return int(match[1])
+
+
+def _download_response(
+    response, id_, part, progress=None, usage=None, chunk_size=CHUNK_SIZE
+):
+    """Write (or append) a ready export to the partial download"""
+    with response:
+        offset = _resume_offset(response, part)
+        if not offset:
+            if usage is not None:
+                usage.update(-_part_size(part))
+            _write_validator(part, response)
+        length = response.headers.get("Content-Length")
+        expected = offset + int(length) if length is not None else None
+
+        # switch progress bar from 'waiting for' to 'downloading'
+        if progress is not None:
+            progress.reset()
+            progress.total = expected or 0
+            progress.unit = "B"
+            progress.unit_scale = True
+            progress.unit_divisor = 1024
+            progress.set_description(f"Download dataset {id_}")
+            progress.update(offset)
+
+        # download exported dataset
+        with open(part, "ab" if offset else "wb") as output_file:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                output_file.write(chunk)
+                if progress is not None:
+                    progress.update(len(chunk))
+                if usage is not None:
+                    usage.update(len(chunk))
+            size = output_file.tell()
+
+    if expected is not None and size != expected:
+        raise RequestException(f"Incomplete download, got {size} of {expected} bytes")
+
+
+def _download_export(
+    session,
+    url,
+    params,
+    response,
+    id_,
+    output,
+    progress=None,
+    usage=None,
+    chunk_size=CHUNK_SIZE,
+):
+    """Download a ready export, resuming the partial download when the
+    connection drops, and rename it to output once it is complete.
+
+    Returns the number of bytes added by this download and the time spent.
+    """
+    part = part_path(output)
+    if usage is not None:
+        usage.update(_part_size(part))
+    # a complete response replaces a stale partial download
+    resumed = _part_size(part) if response.status_code == 206 else 0
+
+    start = time.monotonic()
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        try:
+            _download_response(response, id_, part, progress, usage, chunk_size)
+            break
+        except RequestException:
+            if attempt == DOWNLOAD_ATTEMPTS:
+                raise
+
+        response = _export_request(session, url, params, part)
+        if response is None:
+            raise RequestException("Export is no longer available")
+
+    elapsed = time.monotonic() - start
+    received = _part_size(part) - resumed
+    os.replace(part, output)
+    _validator_path(part).unlink(missing_ok=True)
+    return received, elapsed
+
+
+def make_session(auth=None, pool_size=MAX_CONCURRENCY, retries=RETRIES):
+    """HTTP session with a connection pool that can be shared by the download
+    workers, and that retries failed connections and server errors"""
+    retry = Retry(
+        total=retries,
+        backoff_factor=RETRY_BACKOFF,
+        status_forcelist=RETRY_STATUS,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+
+    session = requests.Session()
+    session.auth = auth
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _export_params(cvat_params, id_, dataset_format, class_):
+    cvat_url, _ = cvat_params
+    url = urljoin(cvat_url, f"api/{class_}s/{id_}/dataset")
+    params = {"format": DATASET_FORMATS.get(dataset_format, dataset_format)}
+    return url, params
+
+
+def _session_context(cvat_params, session):
+    if session is not None:
+        return nullcontext(session)
+    return make_session(cvat_params[1], pool_size=1)
 
 
 def cvat_export_dataset(
-    cvat_params, id_, output, dataset_format, class_="task", progress=None
+    cvat_params,
+    id_,
+    output,
+    dataset_format,
+    class_="task",
+    progress=None,
+    session=None,
+    chunk_size=CHUNK_SIZE,
 ):
-    """Download a dataset from CVAT"""
-
-    _format = {
-        "datumaro": "Datumaro 1.0",
-        "coco": "COCO 1.0",
-        "pascal": "PASCAL VOC 1.1",
-        "labelme": "LabelMe 3.0",
-        "mask": "Segmentation mask 1.1",
-        "mot": "MOT 1.1",
-        "tfrecord": "TFRecord 1.0",
-        "yolo": "YOLO 1.1",
-    }.get(dataset_format, dataset_format)
-
-    with requests.Session() as session:
-        cvat_url, auth = cvat_params
-        session.auth = auth
-
-        url = urljoin(cvat_url, f"api/{class_}s/{id_}/dataset")
-        params = {"format": _format}
-        creating = True
+    """Download a dataset from CVAT, returns the number of bytes downloaded
+    and the time spent downloading"""
+    url, params = _export_params(cvat_params, id_, dataset_format, class_)
+    delays = poll_delays()
 
+    with _session_context(cvat_params, session) as session:
         # request export of the dataset and wait for it to be ready
-        while True:
-            with session.get(url, params=params, stream=True) as response:
-                response.raise_for_status()
-
-                if response.status_code == 200:
-                    if response.headers["Content-Type"] != "application/zip":
-                        raise RequestException("Unexpected response content type")
-
-                    # file is ready for download
-                    # switch progress bar from 'waiting for' to 'downloading'
-                    if progress is not None:
-                        progress.reset()
-                        progress.total = int(response.headers.get("Content-Length", 0))
-                        progress.unit = "B"
-                        progress.unit_scale = True
-                        progress.unit_divisor = 1024
-                        progress.set_description(f"Download dataset {id_}")
-
-                    # download exported dataset
-                    with open(output, "wb") as output_file:
-                        for chunk in response.iter_content(chunk_size=4096):
-                            output_file.write(chunk)
-                            if progress is not None:
-                                progress.update(len(chunk))
-                    break
-
-            if creating:
-                params["action"] = "download"
-                creating = False
-                continue
+        part = part_path(output)
+        response = _export_request(session, url, params, part)
+        params["action"] = "download"
+        while response is None:
+            if progress is not None:
+                progress.update(0)
+            time.sleep(next(delays))
+            response = _export_request(session, url, params, part)
+
+        return _download_export(
+            session,
+            url,
+            params,
+            response,
+            id_,
+            output,
+            progress,
+            chunk_size=chunk_size,
+        )
+
+
+async def cvat_export_dataset_async(
+    cvat_params,
+    id_,
+    output,
+    dataset_format,
+    class_="task",
+    progress=None,
+    executor=None,
+    usage=None,
+    session=None,
+    chunk_size=CHUNK_SIZE,
+):
+    """Download a dataset from CVAT without blocking the event loop.
 
+    Requests run in the executor, while waiting for the export to be ready
+    does not occupy a thread. Returns the number of bytes downloaded and the
+    time spent downloading.
+    """
+    loop = asyncio.get_running_loop()
+    url, params = _export_params(cvat_params, id_, dataset_format, class_)
+    delays = poll_delays()
+
+    with _session_context(cvat_params, session) as session:
+        request = partial(_export_request, session, url)
+        part = part_path(output)
+        response = await loop.run_in_executor(executor, request, params, part)
+        params["action"] = "download"
+        while response is None:
             if progress is not None:
                 progress.update(0)
-            time.sleep(1)
+            await asyncio.sleep(next(delays))
+            response = await loop.run_in_executor(executor, request, params, part)
+
+        download = partial(
+            _download_export,
+            session,
+            url,
+            params,
+            response,
+            id_,
+            output,
+            progress,
+            usage,
+            chunk_size,
+        )
+        return await loop.run_in_executor(executor, download)
+
+
+def cvat_updated_date(session, cvat_url, id_, class_="task"):
+    """Time the project/task/job or its annotations were last changed"""
+    url = urljoin(cvat_url, f"api/{class_}s/{id_}")
+    with session.get(url) as response:
+        response.raise_for_status()
+        return response.json()["updated_date"]
+
+
+def file_digest(path, chunk_size=CHUNK_SIZE):
+    """SHA-256 digest of a file"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as input_file:
+        for chunk in iter(partial(input_file.read, chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 
+class SyncManifest:
+    """Record of the datasets downloaded by tpod-download --sync, keyed by
+    output name, with the CVAT updated_date, format and archive digest"""
 
-def unzip_dataset(dataset):
+    def __init__(self, path):
+        self.path = Path(path)
+        try:
+            with self.path.open() as manifest_file:
+                self._entries = json.load(manifest_file)
+        except FileNotFoundError:
+            self._entries = {}
+
+    def get(self, name):
+        return self._entries.get(name)
+
+    def update(self, name, entry):
+        """Add or replace an entry and write the manifest"""
+        self._entries[name] = entry
+        tmp_path = self.path.with_name(f"{self.path.name}.tmp")
+        with tmp_path.open("w") as manifest_file:
+            json.dump(self._entries, manifest_file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def unzip_dataset(dataset, usage=None):
     """Unzip a zip archive and remove the file"""
     output_dir = Path(dataset.stem)
-    output_dir.mkdir()
 
+    # a broken archive does not leave an empty dataset directory behind
     with zipfile.ZipFile(dataset) as archive:
-        archive.extractall(path=output_dir)
-        # members = archive.infolist()
-        # for zipinfo in members:
-        #    archive.extract(zipinfo, output_dir)
+        output_dir.mkdir()
+        for zipinfo in archive.infolist():
+            archive.extract(zipinfo, output_dir)
+            if usage is not None:
+                usage.update(zipinfo.file_size)
 
+    if usage is not None:
+        usage.update(-os.path.getsize(dataset))
     os.unlink(dataset)
 
 
-def _cvat_export_dataset_cli(
-    cvat_params, id_, dataset_format, position, class_="task", unzip=True
+async def _cvat_export_dataset_cli(
+    cvat_params,
+    id_,
+    dataset_format,
+    position,
+    slots,
+    executor,
+    extractor,
+    usage,
+    class_="task",
+    unzip=True,
+    session=None,
+    chunk_size=CHUNK_SIZE,
+    manifest=None,
 ):
-    """Download a dataset from CVAT (with progress bar)"""
+    """Download a dataset from CVAT (with progress bar), returns whether the
+    dataset was downloaded.
+
+    Without a manifest, existing datasets are skipped. With a manifest, a
+    dataset is only downloaded again when it was changed in CVAT.
+    """
 
     output = Path(f"{dataset_format}_{class_}_{id_}")
     output_zip = output.with_suffix(".zip")
-    if output.exists():
-        print(f"{output} already exists, skipping download")
-        return
+    target = output if unzip else output_zip
+    if manifest is None and output.exists():
+        tqdm.write(f"{output} already exists, skipping download")
+        return False
 
+    loop = asyncio.get_running_loop()
+    start = time.monotonic()
     with tqdm(
         desc=f"Exporting dataset for {class_} {id_}",
         position=position,
         leave=False,
     ) as pbar:
+        async with slots:
+            try:
+                if manifest is not None:
+                    updated_date = await loop.run_in_executor(
+                        executor,
+                        partial(
+                            cvat_updated_date,
+                            session,
+                            cvat_params[0],
+                            id_,
+                            class_=class_,
+                        ),
+                    )
+                    entry = manifest.get(output.name)
+                    if (
+                        entry is not None
+                        and entry["updated_date"] == updated_date
+                        and target.exists()
+                    ):
+                        tqdm.write(f"{target} is up to date")
+                        return False
+
+                received, elapsed = await cvat_export_dataset_async(
+                    cvat_params,
+                    id_,
+                    output_zip,
+                    dataset_format,
+                    class_=class_,
+                    progress=pbar,
+                    executor=executor,
+                    usage=usage,
+                    session=session,
+                    chunk_size=chunk_size,
+                )
+
+            # RequestException is an OSError, as are errors writing the file,
+            # unexpected metadata raises KeyError or ValueError
+            except (OSError, KeyError, ValueError) as exc:
+                tqdm.write(f"Failed exporting dataset {id_}: {exc}")
+                return False
+
+        # the next dataset can be downloaded while this one is unpacked
         try:
-            cvat_export_dataset(
-                cvat_params,
-                id_,
-                output_zip,
-                dataset_format,
-                class_=class_,
-                progress=pbar,
+            if manifest is not None:
+                pbar.set_description(f"Checksumming {output_zip}")
+                digest = await loop.run_in_executor(extractor, file_digest, output_zip)
+            if unzip:
+                pbar.set_description(f"Unpacking {output_zip}")
+                if output.exists():
+                    # replace the outdated dataset
+                    await loop.run_in_executor(extractor, shutil.rmtree, output)
+                await loop.run_in_executor(extractor, unzip_dataset, output_zip, usage)
+        except (OSError, zipfile.BadZipFile) as exc:
+            tqdm.write(f"Failed unpacking dataset {id_}: {exc}")
+            return False
+
+        if manifest is not None:
+            manifest.update(
+                output.name,
+                {
+                    "id": id_,
+                    "class": class_,
+                    "format": dataset_format,
+                    "updated_date": updated_date,
+                    "sha256": digest,
+                },
             )
+    throughput = received / max(elapsed, 1e-6) / 1e6
+    tqdm.write(
+        f"Downloaded {output} in {time.monotonic() - start:.1f}s "
+        f"({throughput:.1f} MB/s)"
+    )
+    return True
 
-        except requests.exceptions.RequestException as exc:
-            tqdm.write(f"Failed exporting dataset {id_}: {exc}")
-            return
 
-        if unzip:
-            pbar.set_description(f"Unpacking {output_zip}")
-            unzip_dataset(output_zip)
-        tqdm.write(f"Downloaded {output}")
+async def _cvat_export_datasets_cli(
+    ids, max_concurrency, cvat_params, pool_size=None, retries=RETRIES, **kwargs
+):
+    """Download datasets, at most max_concurrency at the same time over one
+    shared connection pool, and unpack them in separate workers. A failed
+    dataset is reported and does not cancel the other downloads."""
+    slots = asyncio.Semaphore(max_concurrency)
+    usage = DiskUsage()
+    start = time.monotonic()
+
+    session = make_session(
+        cvat_params[1], pool_size=pool_size or max_concurrency, retries=retries
+    )
+    with session, ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        with ThreadPoolExecutor(max_workers=max_concurrency) as extractor:
+            downloaded = await asyncio.gather(
+                *(
+                    _cvat_export_dataset_cli(
+                        cvat_params,
+                        id_=id_,
+                        position=position,
+                        slots=slots,
+                        executor=executor,
+                        extractor=extractor,
+                        usage=usage,
+                        session=session,
+                        **kwargs,
+                    )
+                    for position, id_ in enumerate(ids, 1)
+                ),
+                return_exceptions=True,
+            )
+
+    for id_, result in zip(ids, downloaded):
+        if isinstance(result, Exception):
+            tqdm.write(f"Failed downloading dataset {id_}: {result!r}")
+    downloaded = [result is True for result in downloaded]
+
+    if any(downloaded):
+        peak = tqdm.format_sizeof(usage.peak, "B", 1024)
+        tqdm.write(
+            f"Downloaded {sum(downloaded)} datasets in "
+            f"{time.monotonic() - start:.1f}s, peak disk usage {peak}"
+        )
 
 
 def main():
@@ -143,6 +611,43 @@ def main():
     parser.add_argument(
         "--no-unzip", action="store_true", help="Do not unpack datasets after download"
     )
+    parser.add_argument(
+        "-j",
+        "--max-concurrency",
+        type=int,
+        default=MAX_CONCURRENCY,
+        help="Maximum number of simultaneous exports and downloads "
+        f"(defaults to {MAX_CONCURRENCY})",
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Only download datasets again when they were changed in CVAT",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=Path,
+        default=DEFAULT_MANIFEST,
+        help=f"Record of synced datasets for --sync (defaults to {DEFAULT_MANIFEST})",
+    )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        help="Number of pooled connections to CVAT (defaults to --max-concurrency)",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=RETRIES,
+        help=f"Retries of failed connections and server errors (defaults to {RETRIES})",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=CHUNK_SIZE // 1024,
+        metavar="KIB",
+        help=f"Download chunk size in KiB (defaults to {CHUNK_SIZE // 1024})",
+    )
     parser.add_argument(
         "-f",
         "--format",
@@ -171,17 +676,32 @@ def main():
     else:  # args.task | default
         class_ = "task"
 
-    export_dataset = partial(
-        _cvat_export_dataset_cli,
-        (args.url, _auth),
-        dataset_format=args.format,
-        class_=class_,
-        unzip=not args.no_unzip,
-    )
+    if args.max_concurrency < 1:
+        parser.error("--max-concurrency must be at least 1")
+    if args.pool_size is not None and args.pool_size < 1:
+        parser.error("--pool-size must be at least 1")
+    if args.chunk_size < 1:
+        parser.error("--chunk-size must be at least 1")
+
+    try:
+        manifest = SyncManifest(args.manifest) if args.sync else None
+    except (OSError, ValueError) as exc:
+        parser.error(f"Unable to read {args.manifest}: {exc}")
 
-    with ThreadPoolExecutor() as pool:
-        for position, id_ in enumerate(args.id, 1):
-            pool.submit(export_dataset, id_, position=position)
+    asyncio.run(
+        _cvat_export_datasets_cli(
+            args.id,
+            args.max_concurrency,
+            cvat_params=(args.url, _auth),
+            pool_size=args.pool_size,
+            retries=args.retries,
+            chunk_size=args.chunk_size * 1024,
+            dataset_format=args.format,
+            class_=class_,
+            unzip=not args.no_unzip,
+            manifest=manifest,
+        )
+    )
     print()
 
 
@@ -0,0 +1,79 @@
+# SPDX-FileCopyrightText: 2024 Carnegie Mellon University
+# SPDX-License-Identifier: Apache-2.0
+
+"""CNN image embeddings for semantic near-duplicate detection"""
+
+from __future__ import annotations
+
+from typing import Sequence
+
+import numpy as np
+from PIL import Image
+
+# images are resized to the model input resolution
+INPUT_SIZE = 224
+
+# ImageNet normalization used by the torchvision pretrained models
+IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+IMAGENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+class EmbeddingModel:
+    """Pretrained torchvision MobileNetV2 without its classifier, returns L2
+    normalized 1280 dimensional feature vectors.
+
+    PyTorch is only imported when the model is created, so it is only needed
+    when embeddings are actually used.
+    """
+
+    name = "mobilenet_v2"
+    dim = 1280
+
+    def __init__(self, device: str = "cpu"):
+        try:
+            import torch
+            import torchvision
+        except ImportError as exc:
+            raise ImportError(
+                "Embeddings require torch and torchvision to be installed"
+            ) from exc
+
+        try:
+            weights = torchvision.models.MobileNet_V2_Weights.DEFAULT
+            model = torchvision.models.mobilenet_v2(weights=weights)
+        except AttributeError:  # torchvision < 0.13
+            model = torchvision.models.mobilenet_v2(pretrained=True)
+        model.classifier = torch.nn.Identity()
+
+        self._torch = torch
+        self._device = torch.device(device)
+        self._model = model.eval().to(self._device)
+
+    @staticmethod
+    def preprocess(images: Sequence[Image.Image]) -> np.ndarray:
+        """Resize and normalize a list of images into an NCHW float32 array"""
+        pixels = np.stack(
+            [
+                np.asarray(
+                    image.convert("RGB").resize(
+                        (INPUT_SIZE, INPUT_SIZE), Image.BILINEAR
+                    ),
+                    dtype=np.float32,
+                )
+                for image in images
+            ]
+        )
+        pixels = (pixels / 255 - IMAGENET_MEAN) / IMAGENET_STD
+        return np.ascontiguousarray(pixels.transpose(0, 3, 1, 2))
+
+    def __call__(self, images: Sequence[Image.Image]) -> np.ndarray:
+        """Embeddings for a batch of images as an (N, dim) array"""
+        if not len(images):
+            return np.empty((0, self.dim), dtype=np.float32)
+
+        batch = self._torch.from_numpy(self.preprocess(images)).to(self._device)
+        with self._torch.no_grad():
+            features = self._model(batch).cpu().numpy()
+
+        norms = np.linalg.norm(features, axis=1, keepdims=True)
+        return features / np.maximum(norms, 1e-12)
@@ -7,12 +7,246 @@
 """Filter datasets
 """
 
+from __future__ import annotations
+
 import argparse
+import json
 from pathlib import Path
 
-import datumaro as dm
+import numpy as np
+import yaml
+from datumaro.components.annotation import AnnotationType
+from datumaro.components.transformer import ItemTransform
+
+from .checkpoint import Checkpoint, checkpoint_path
+from .utils import datumaro_fixup, import_dataset
+
+
+def attribute_equals(name, value):
+    """Predicate for annotations with an attribute that has the given value.
+
+    Values are compared as strings, the same way the Datumaro XPath filter
+    compares the text of attribute elements, i.e. occluded=False matches
+    `/item/annotation[occluded="False"]`. Annotations without the attribute
+    never match.
+    """
+
+    def predicate(annotation):
+        attributes = annotation.attributes
+        return name in attributes and str(attributes[name]) == value
+
+    return predicate
+
+
+# bounding box measures that can be limited with min_<measure>/max_<measure>
+BOX_MEASURES = {
+    "area": lambda x, y, w, h: w * h,
+    "width": lambda x, y, w, h: w,
+    "height": lambda x, y, w, h: h,
+    "aspect": lambda x, y, w, h: np.divide(
+        w, h, out=np.full_like(w, np.inf), where=h > 0
+    ),
+}
+RULE_KEYS = {
+    *(f"{limit}_{measure}" for limit in ["min", "max"] for measure in BOX_MEASURES),
+    "min_edge_distance",
+    "labels",
+    "exclude_labels",
+    "attributes",
+    "min_annotations",
+    "max_annotations",
+}
+
+
+def load_rules(path):
+    """Read a filter rule specification from a YAML or JSON file"""
+    with open(path) as rules_file:
+        rules = yaml.safe_load(rules_file) or {}
+    if not isinstance(rules, dict):
+        raise ValueError(f"{path} does not contain a mapping of filter rules")
+    return rules
+
+
+def parse_rule(spec):
+    """Parse a KEY=VALUE rule from the command line, values are JSON or a
+    comma separated list of labels"""
+    key, _, value = spec.partition("=")
+    if key in ["labels", "exclude_labels"]:
+        return key, value.split(",")
+    try:
+        return key, json.loads(value)
+    except json.JSONDecodeError:
+        raise ValueError(f"Invalid value in filter rule {spec}") from None
+
+
+class FilterRules:
+    """Annotation and frame filter rules, compiled into NumPy checks over
+    the array of bounding boxes of an item.
+
+    Annotations are kept when their box is within the min_/max_ limits of
+    area, width, height, and aspect (width / height), is at least
+    min_edge_distance pixels from the image border, their label is in
+    `labels` and not in `exclude_labels`, and they have the given
+    `attributes`. Box rules do not apply to annotations without a box.
+    Frames with fewer than min_annotations or more than max_annotations kept
+    annotations are dropped.
+    """
+
+    def __init__(self, rules: dict, label_names=()):
+        unknown = set(rules) - RULE_KEYS
+        if unknown:
+            raise ValueError(f"Unknown filter rules {', '.join(sorted(unknown))}")
+
+        self._box_checks = []
+        for key, value in rules.items():
+            limit, _, measure = key.partition("_")
+            if measure in BOX_MEASURES:
+                compare = np.greater_equal if limit == "min" else np.less_equal
+                self._box_checks.append((BOX_MEASURES[measure], compare, float(value)))
+
+        self._edge_distance = rules.get("min_edge_distance")
+        self._labels = self._label_ids(rules.get("labels"), label_names)
+        self._exclude_labels = self._label_ids(rules.get("exclude_labels"), label_names)
+        self._predicates = [
+            attribute_equals(name, str(value))
+            for name, value in rules.get("attributes", {}).items()
+        ]
+        self._min_annotations = rules.get("min_annotations", 0)
+        self._max_annotations = rules.get("max_annotations")
+
+    @staticmethod
+    def _label_ids(names, label_names):
+        if names is None:
+            return None
+        label_names = list(label_names)
+        unknown = set(names) - set(label_names)
+        if unknown:
+            raise ValueError(f"Unknown labels {', '.join(sorted(unknown))}")
+        return np.array([label_names.index(name) for name in names], dtype=int)
+
+    def _box_mask(self, item, boxes):
+        x, y, w, h = boxes.T
+        keep = np.ones(len(boxes), dtype=bool)
+        for measure, compare, value in self._box_checks:
+            keep &= compare(measure(x, y, w, h), value)
+
+        size = getattr(item.media, "size", None) if item.media is not None else None
+        if self._edge_distance is not None and size is not None:
+            height, width = size
+            edge = np.min([x, y, width - (x + w), height - (y + h)], axis=0)
+            keep &= edge >= self._edge_distance
+        return keep
+
+    def annotation_mask(self, item) -> np.ndarray:
+        """Boolean mask of the annotations of an item that pass all rules"""
+        annotations = item.annotations
+        keep = np.ones(len(annotations), dtype=bool)
+
+        has_box = np.array(
+            [hasattr(annotation, "get_bbox") for annotation in annotations],
+            dtype=bool,
+        )
+        if self._box_checks or self._edge_distance is not None:
+            boxes = np.array(
+                [
+                    annotation.get_bbox()
+                    for annotation in annotations
+                    if hasattr(annotation, "get_bbox")
+                ],
+                dtype=np.float64,
+            ).reshape(-1, 4)
+            keep[has_box] = self._box_mask(item, boxes)
+
+        if self._labels is not None or self._exclude_labels is not None:
+            labels = np.array(
+                [
+                    (
+                        -1
+                        if getattr(annotation, "label", None) is None
+                        else annotation.label
+                    )
+                    for annotation in annotations
+                ],
+                dtype=int,
+            )
+            if self._labels is not None:
+                keep &= np.isin(labels, self._labels)
+            if self._exclude_labels is not None:
+                keep &= ~np.isin(labels, self._exclude_labels)
+
+        for index in np.flatnonzero(keep):
+            annotation = annotations[index]
+            keep[index] = all(predicate(annotation) for predicate in self._predicates)
+        return keep
+
+    def keep_item(self, count: int) -> bool:
+        """Are there an acceptable number of kept annotations in a frame"""
+        if count < self._min_annotations:
+            return False
+        return self._max_annotations is None or count <= self._max_annotations
 
-from .utils import datumaro_fixup
+
+class AnnotationFilterTransform(ItemTransform):
+    """Keep the annotations for which all predicates hold, and drop items
+    without remaining annotations.
+
+    This is a single pass over the items that calls Python predicates on the
+    annotations, instead of serializing every item to XML for each Datumaro
+    XPath filter. An optional checkpoint records the positions of the kept
+    annotations of every item, items that are already in the checkpoint are
+    not filtered again.
+    """
+
+    def __init__(
+        self,
+        extractor,
+        predicates=(),
+        rules: FilterRules | dict | None = None,
+        remove_empty: bool = True,
+        checkpoint: Checkpoint | None = None,
+    ):
+        super().__init__(extractor)
+        if isinstance(rules, dict):
+            labels = extractor.categories().get(AnnotationType.label)
+            rules = FilterRules(rules, [label.name for label in labels or []])
+        self._predicates = list(predicates)
+        self._rules = rules
+        self._remove_empty = remove_empty
+        self._checkpoint = checkpoint
+
+    def _filter(self, item):
+        """Positions of the kept annotations, or None to drop the item"""
+        if self._rules is None:
+            candidates = range(len(item.annotations))
+        else:
+            candidates = np.flatnonzero(self._rules.annotation_mask(item)).tolist()
+
+        kept = [
+            index
+            for index in candidates
+            if all(predicate(item.annotations[index]) for predicate in self._predicates)
+        ]
+        if self._rules is not None and not self._rules.keep_item(len(kept)):
+            return None
+        return kept
+
+    def transform_item(self, item):
+        key = (item.id, item.subset)
+        if self._checkpoint is None:
+            kept = self._filter(item)
+        elif key in self._checkpoint:
+            kept = self._checkpoint.get(key)
+        else:
+            kept = self._filter(item)
+            self._checkpoint.put(key, kept)
+
+        if kept is None or (self._remove_empty and not kept):
+            return None
+        if len(kept) == len(item.annotations):
+            return item
+        return self.wrap_item(
+            item, annotations=[item.annotations[index] for index in kept]
+        )
 
 
 def main():
@@ -27,6 +261,19 @@ def main():
         action="store_true",
         help="Do not drop hidden or occluded annotations",
     )
+    parser.add_argument(
+        "--rules",
+        type=Path,
+        help="YAML or JSON file with annotation and frame filter rules",
+    )
+    parser.add_argument(
+        "--rule",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help=f"""Additional filter rule, i.e. min_area=100 or
+        exclude_labels=person,sign [{', '.join(sorted(RULE_KEYS))}]""",
+    )
     parser.add_argument(
         "--save-images",
         action="store_true",
@@ -39,36 +286,89 @@ def main():
         default="filtered",
         help="Filtered dataset name (defaults to 'filtered')",
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="""Read and write items incrementally, memory use does not grow
+        with the size of the dataset (no checkpoint is kept)""",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=Path,
+        help="""Record filtered items in this file (defaults to
+        <output>.checkpoint.jsonl), it is removed after a successful run""",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run from the items in the checkpoint",
+    )
     parser.add_argument("dataset", type=Path, help="path of dataset to filter")
     args = parser.parse_args()
 
+    try:
+        rules = load_rules(args.rules) if args.rules else {}
+        rules.update(parse_rule(rule) for rule in args.rule)
+    except (OSError, ValueError, yaml.YAMLError) as exc:
+        parser.error(str(exc))
+
     print("Importing", args.dataset)
+    if args.stream and args.resume:
+        parser.error("--stream does not support --resume")
+
     datumaro_fixup(args.dataset)
-    dataset = dm.Dataset.import_from(str(args.dataset))
+    dataset = import_dataset(args.dataset, stream=args.stream)
 
     if args.verbose:
         print("IMPORTED", dataset)
 
+    config = dict(
+        dataset=str(args.dataset.resolve()),
+        filter_occluded=args.filter_occluded,
+        rules=rules,
+    )
+    checkpoint = None
+    if not args.stream:
+        try:
+            checkpoint = Checkpoint(
+                args.checkpoint or checkpoint_path(args.output),
+                config,
+                resume=args.resume,
+            )
+        except ValueError as exc:
+            parser.error(str(exc))
+        if len(checkpoint):
+            print(f"Resuming after {len(checkpoint)} checkpointed items")
+
+    predicates = []
     if args.filter_occluded:
         print("- Removing occluded annotations")
-        dataset = dataset.filter(
-            '/item/annotation[occluded="False"]',
-            filter_annotations=True,
-            remove_empty=True,
-        )
+        predicates.append(attribute_equals("occluded", "False"))
 
-        if args.verbose:
-            print("REMOVED OCCLUSIONS", dataset)
+    if rules:
+        print("- Applying filter rules")
+        labels = dataset.categories().get(AnnotationType.label)
+        try:
+            rules = FilterRules(rules, [label.name for label in labels or []])
+        except ValueError as exc:
+            parser.error(str(exc))
 
     # remove frames with no annotations
     print("- Removing empty frames")
-    filtered_dataset = dataset.filter("//*", filter_annotations=True, remove_empty=True)
+    filtered_dataset = dataset.transform(
+        AnnotationFilterTransform,
+        predicates=predicates,
+        rules=rules or None,
+        checkpoint=checkpoint,
+    )
 
     if args.verbose:
-        print("REMOVED EMPTY FRAMES", dataset)
+        print("FILTERED", filtered_dataset)
 
     filtered_dataset.save(str(args.output), save_media=args.save_images)
     datumaro_fixup(args.output)
+    if checkpoint is not None:
+        checkpoint.remove()
 
 
 if __name__ == "__main__":
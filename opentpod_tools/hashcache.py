@@ -0,0 +1,126 @@
+# SPDX-FileCopyrightText: 2024 Carnegie Mellon University
+# SPDX-License-Identifier: Apache-2.0
+
+"""Persistent cache of image hashes and embeddings"""
+
+from __future__ import annotations
+
+import os
+import sqlite3
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from .xdg import XDG_CACHE_DIR
+
+DEFAULT_CACHE_FILE = XDG_CACHE_DIR / "imagehash.sqlite"
+DEFAULT_EMBEDDING_CACHE_FILE = XDG_CACHE_DIR / "embeddings.sqlite"
+
+# number of new entries buffered before they are committed to the database
+COMMIT_INTERVAL = 1000
+
+
+class HashCache:
+    """SQLite backed cache of image hashes.
+
+    Entries are keyed by the absolute path of the media file and the name of
+    the hash algorithm, and are only valid as long as the file size and
+    modification time did not change.
+    """
+
+    TABLE = "hashes"
+    COLUMN = "hash TEXT"
+
+    def __init__(self, path: Path | str = DEFAULT_CACHE_FILE):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._db = sqlite3.connect(str(path), timeout=60)
+        self._db.execute(
+            f"""CREATE TABLE IF NOT EXISTS {self.TABLE} (
+                path TEXT NOT NULL,
+                algorithm TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                {self.COLUMN} NOT NULL,
+                PRIMARY KEY (path, algorithm)
+            )"""
+        )
+        self._pending = 0
+
+    @staticmethod
+    def _encode(value: int) -> str:
+        # stored as hex text, sqlite integers are signed 64-bit
+        return f"{value:x}"
+
+    @staticmethod
+    def _decode(value: str) -> int:
+        return int(value, 16)
+
+    @staticmethod
+    def _key(path: str) -> tuple[str, int, int]:
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+    def get(self, path: str, algorithm: str) -> Any:
+        """Return the cached hash for a file, or None when the file is not in
+        the cache or has been modified since it was hashed."""
+        try:
+            abspath, size, mtime_ns = self._key(path)
+        except OSError:
+            return None
+
+        column = self.COLUMN.split()[0]
+        row = self._db.execute(
+            f"SELECT {column} FROM {self.TABLE}"
+            " WHERE path = ? AND algorithm = ? AND size = ? AND mtime_ns = ?",
+            (abspath, algorithm, size, mtime_ns),
+        ).fetchone()
+        return self._decode(row[0]) if row is not None else None
+
+    def put(self, path: str, algorithm: str, value: Any) -> None:
+        try:
+            abspath, size, mtime_ns = self._key(path)
+        except OSError:
+            return
+
+        self._db.execute(
+            f"INSERT OR REPLACE INTO {self.TABLE} VALUES (?, ?, ?, ?, ?)",
+            (abspath, algorithm, size, mtime_ns, self._encode(value)),
+        )
+        self._pending += 1
+        if self._pending >= COMMIT_INTERVAL:
+            self.flush()
+
+    def flush(self) -> None:
+        self._db.commit()
+        self._pending = 0
+
+    def close(self) -> None:
+        self.flush()
+        self._db.close()
+
+    def __enter__(self) -> HashCache:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class EmbeddingCache(HashCache):
+    """SQLite backed cache of image embeddings, stored as float16 vectors"""
+
+    TABLE = "embeddings"
+    COLUMN = "embedding BLOB"
+
+    def __init__(self, path: Path | str = DEFAULT_EMBEDDING_CACHE_FILE):
+        super().__init__(path)
+
+    @staticmethod
+    def _encode(value: np.ndarray) -> bytes:
+        return np.asarray(value, dtype="<f2").tobytes()
+
+    @staticmethod
+    def _decode(value: bytes) -> np.ndarray:
+        return np.frombuffer(value, dtype="<f2").astype(np.float32)
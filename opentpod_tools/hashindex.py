@@ -0,0 +1,418 @@
+# SPDX-FileCopyrightText: 2024 Carnegie Mellon University
+# SPDX-License-Identifier: Apache-2.0
+
+"""Hamming space indexes for perceptual image hashes"""
+
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Any, Iterator
+
+import numpy as np
+
+# number of hashes in a BK-tree leaf before it is split
+LEAF_SIZE = 512
+
+# reference index file header, magic, the name of the hash algorithm and how
+# the images were decoded
+REFERENCE_MAGIC = b"TPODHIDX"
+REFERENCE_HEADER_SIZE = 32
+REFERENCE_DECODES = {b"draft": True, b"full": False}
+
+# random hyperplane LSH parameters, bits per bucket code and number of tables
+LSH_BITS = 10
+LSH_TABLES = 12
+
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def hash_to_int(image_hash: Any) -> int:
+    """Convert an imagehash.ImageHash to an integer with the same bit order
+    as its hexadecimal representation."""
+    bits = "".join("1" if bit else "0" for bit in image_hash.hash.flatten())
+    return int(bits or "0", 2)
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """Number of differing bits between two integer hashes"""
+    return bin(a ^ b).count("1")
+
+
+def popcount64(values: np.ndarray) -> np.ndarray:
+    """Number of set bits in each element of an uint64 array"""
+    if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+        return np.bitwise_count(values)
+    octets = np.ascontiguousarray(values, dtype=np.uint64).view(np.uint8)
+    return _POPCOUNT8[octets].reshape(*values.shape, 8).sum(axis=-1, dtype=np.uint8)
+
+
+class GrowableArray:
+    """Append-only NumPy array with amortized constant time appends, elements
+    are scalars or rows of a fixed `shape`"""
+
+    def __init__(self, dtype: Any, capacity: int = 64, shape: tuple = ()):
+        self._data = np.empty((capacity, *shape), dtype=dtype)
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    @property
+    def values(self) -> np.ndarray:
+        return self._data[: self._len]
+
+    def _reserve(self, size: int) -> None:
+        if size > len(self._data):
+            capacity = max(size, 2 * len(self._data))
+            data = np.empty((capacity, *self._data.shape[1:]), dtype=self._data.dtype)
+            data[: self._len] = self.values
+            self._data = data
+
+    def append(self, value: Any) -> None:
+        self._reserve(self._len + 1)
+        self._data[self._len] = value
+        self._len += 1
+
+    def extend(self, values: Any) -> None:
+        values = np.asarray(values, dtype=self._data.dtype)
+        self._reserve(self._len + len(values))
+        self._data[self._len : self._len + len(values)] = values
+        self._len += len(values)
+
+
+class HashArray(GrowableArray):
+    """Growable array of 64-bit integer hashes"""
+
+    def __init__(self, capacity: int = 64):
+        super().__init__(np.uint64, capacity)
+
+    def distances(self, value: int, indices: Any = None) -> np.ndarray:
+        """Hamming distances between value and the (selected) stored hashes"""
+        values = self.values if indices is None else self.values[indices]
+        return popcount64(values ^ np.uint64(value))
+
+    def any_within(self, value: int, radius: int, indices: Any = None) -> bool:
+        """Is there any (selected) hash at most `radius` bits away from value"""
+        if radius < 0 or not len(self):
+            return False
+        return bool((self.distances(value, indices) <= radius).any())
+
+
+class _Leaf:
+    __slots__ = ("hashes", "keys", "limit")
+
+    def __init__(self, limit: int):
+        self.hashes = HashArray()
+        self.keys = GrowableArray(np.int64)
+        self.limit = limit
+
+
+class _Node:
+    __slots__ = ("value", "key", "children")
+
+    def __init__(self, value: int, key: int):
+        self.value = value
+        self.key = key
+        self.children: dict[int, _Node | _Leaf] = {}
+
+
+class BKTree:
+    """Burkhard-Keller tree over integer hashes using the Hamming metric.
+
+    Every child of a node is stored under its distance to that node, so by
+    the triangle inequality a query only has to descend into children whose
+    edge distance lies within `radius` of the distance to the node itself.
+
+    Hashes are kept in packed uint64 leaf buckets that are compared with a
+    single vectorized pass, a leaf is only split into a new tree node when it
+    grows beyond `leaf_size` hashes.
+    """
+
+    def __init__(self, leaf_size: int = LEAF_SIZE) -> None:
+        self._leaf_size = leaf_size
+        self._root: _Node | _Leaf = _Leaf(leaf_size)
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    @classmethod
+    def from_array(cls, hashes: np.ndarray, leaf_size: int = LEAF_SIZE) -> BKTree:
+        """Build a tree from an array of hashes, keyed by their index.
+
+        Leaves are split top down with vectorized passes, which is much
+        faster than adding the hashes one at a time.
+        """
+        tree = cls(leaf_size)
+        root = _Leaf(leaf_size)
+        root.hashes.extend(np.asarray(hashes, dtype=np.uint64))
+        root.keys.extend(np.arange(len(hashes), dtype=np.int64))
+        tree._len = len(hashes)
+
+        tree._root = tree._split_full(root)
+        stack = [tree._root]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, _Node):
+                for edge, child in node.children.items():
+                    child = node.children[edge] = tree._split_full(child)
+                    stack.append(child)
+        return tree
+
+    def _split_full(self, leaf: _Leaf) -> _Node | _Leaf:
+        node = leaf
+        while isinstance(node, _Leaf) and len(node.hashes) > node.limit:
+            node = self._split(node)
+        return node
+
+    def add(self, value: int, key: int | None = None) -> None:
+        """Insert a hash, `key` defaults to the insertion index."""
+        if key is None:
+            key = self._len
+        self._len += 1
+
+        parent, edge, node = None, None, self._root
+        while isinstance(node, _Node):
+            distance = hamming_distance(value, node.value)
+            child = node.children.get(distance)
+            if child is None:
+                child = node.children[distance] = _Leaf(self._leaf_size)
+            parent, edge, node = node, distance, child
+
+        node.hashes.append(value)
+        node.keys.append(key)
+
+        if len(node.hashes) > node.limit:
+            split = self._split(node)
+            if parent is None:
+                self._root = split
+            else:
+                parent.children[edge] = split
+
+    def _split(self, leaf: _Leaf) -> _Node | _Leaf:
+        hashes, keys = leaf.hashes.values, leaf.keys.values
+        distances = popcount64(hashes[1:] ^ hashes[0])
+
+        # identical hashes cannot be partitioned, let the leaf grow instead
+        if not distances.any():
+            leaf.limit *= 2
+            return leaf
+
+        node = _Node(int(hashes[0]), int(keys[0]))
+        for distance in np.unique(distances):
+            selected = np.flatnonzero(distances == distance) + 1
+            child = node.children[int(distance)] = _Leaf(self._leaf_size)
+            child.hashes.extend(hashes[selected])
+            child.keys.extend(keys[selected])
+        return node
+
+    def _search(self, value: int, radius: int) -> Iterator[np.ndarray]:
+        """Yield arrays of keys of stored hashes at most `radius` bits away"""
+        if radius < 0:
+            return
+
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+
+            if isinstance(node, _Leaf):
+                if len(node.hashes):
+                    matches = node.hashes.distances(value) <= radius
+                    if matches.any():
+                        yield node.keys.values[matches]
+                continue
+
+            distance = hamming_distance(value, node.value)
+            if distance <= radius:
+                yield np.array([node.key], dtype=np.int64)
+
+            for edge in range(max(distance - radius, 0), distance + radius + 1):
+                child = node.children.get(edge)
+                if child is not None:
+                    stack.append(child)
+
+    def any_within(self, value: int, radius: int) -> bool:
+        """Is there any stored hash at most `radius` bits away from value"""
+        return next(self._search(value, radius), None) is not None
+
+    def nearest(self, value: int, radius: int) -> int | None:
+        """Distance to the closest stored hash, if it is at most `radius`"""
+        best = None
+        stack = [self._root]
+        while stack and radius >= 0:
+            node = stack.pop()
+
+            if isinstance(node, _Leaf):
+                if len(node.hashes):
+                    distance = int(node.hashes.distances(value).min())
+                    if distance <= radius:
+                        best, radius = distance, distance - 1
+                continue
+
+            distance = hamming_distance(value, node.value)
+            if distance <= radius:
+                best, radius = distance, distance - 1
+
+            for edge in range(max(distance - radius, 0), distance + radius + 1):
+                child = node.children.get(edge)
+                if child is not None:
+                    stack.append(child)
+        return best
+
+    def find_within(self, value: int, radius: int) -> list[int]:
+        """Keys of all stored hashes at most `radius` bits away from value"""
+        return [int(key) for keys in self._search(value, radius) for key in keys]
+
+
+class ReferenceIndex:
+    """Compact on-disk index of 64-bit hashes of previously seen images.
+
+    The file is a 32 byte header, holding a magic number, the name of the
+    hash algorithm and whether the images were decoded at a reduced
+    resolution (NUL separated), followed by little-endian uint64 hashes. The
+    hashes are memory-mapped, so opening even a large index does not require
+    loading it, and a BK-tree is built from them on the first query. New
+    hashes are buffered and appended by flush().
+
+    The algorithm and decode arguments only apply when a new index is
+    created, indexes written before the decode was recorded have
+    reduced_decode set to None.
+    """
+
+    def __init__(
+        self, path: Path | str, algorithm: str = "phash", reduced_decode: bool = True
+    ):
+        self.path = Path(path)
+
+        if not self.path.exists():
+            decode = b"draft" if reduced_decode else b"full"
+            fields = b"\0".join([algorithm.encode(), decode])
+            header = REFERENCE_MAGIC + fields.ljust(24, b"\0")
+            self.path.write_bytes(header)
+
+        with self.path.open("rb") as index:
+            header = index.read(REFERENCE_HEADER_SIZE)
+        if len(header) != REFERENCE_HEADER_SIZE or not header.startswith(
+            REFERENCE_MAGIC
+        ):
+            raise ValueError(f"{self.path} is not a hash reference index")
+
+        algorithm, _, decode = (
+            header[len(REFERENCE_MAGIC) :].rstrip(b"\0").partition(b"\0")
+        )
+        self.algorithm = algorithm.decode()
+        self.reduced_decode = REFERENCE_DECODES.get(decode)
+        self._pending = HashArray()
+        self._tree: BKTree | None = None
+        self._map()
+
+    def _map(self) -> None:
+        count = (self.path.stat().st_size - REFERENCE_HEADER_SIZE) // 8
+        if count:
+            self._hashes = np.memmap(
+                self.path,
+                dtype="<u8",
+                mode="r",
+                offset=REFERENCE_HEADER_SIZE,
+                shape=(count,),
+            )
+        else:
+            self._hashes = np.empty(0, dtype="<u8")
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def any_within(self, value: int, radius: int) -> bool:
+        """Is there any indexed hash at most `radius` bits away from value"""
+        if radius < 0:
+            return False
+
+        if self._tree is None:
+            self._tree = BKTree.from_array(self._hashes)
+        return self._tree.any_within(value, radius)
+
+    def append(self, value: int) -> None:
+        """Add a hash, it only becomes part of the index after flush()"""
+        self._pending.append(value)
+
+    def flush(self) -> None:
+        if not len(self._pending):
+            return
+
+        with self.path.open("ab") as index:
+            index.write(self._pending.values.astype("<u8").tobytes())
+        if self._tree is not None:
+            for value in self._pending.values:
+                self._tree.add(int(value), len(self._tree))
+        self._pending = HashArray()
+        self._map()
+
+
+class CosineLSHIndex:
+    """Approximate nearest neighbour index over embedding vectors.
+
+    Each of the hash tables buckets vectors by the signs of their projections
+    on a set of random hyperplanes (random hyperplane LSH), vectors with a
+    small angle between them end up in the same bucket in at least one table
+    with high probability. Queries compute the exact cosine similarity with
+    all vectors in the matching buckets in a single vectorized pass.
+    """
+
+    def __init__(
+        self,
+        dim: int,
+        bits: int = LSH_BITS,
+        tables: int = LSH_TABLES,
+        seed: int | None = 0,
+    ):
+        rng = np.random.default_rng(seed)
+        self._planes = rng.standard_normal((tables * bits, dim)).astype(np.float32)
+        self._weights = 1 << np.arange(bits, dtype=np.int64)
+        self._bits = bits
+        self._buckets: list[dict[int, list[int]]] = [{} for _ in range(tables)]
+        self._vectors = GrowableArray(np.float32, shape=(dim,))
+
+    def __len__(self) -> int:
+        return len(self._vectors)
+
+    @staticmethod
+    def _normalize(vector: Any) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _codes(self, vector: np.ndarray) -> list[int]:
+        signs = (self._planes @ vector > 0).reshape(len(self._buckets), self._bits)
+        return (signs @ self._weights).tolist()
+
+    def _candidates(self, codes: list[int]) -> np.ndarray:
+        candidates = [
+            bucket[code] for bucket, code in zip(self._buckets, codes) if code in bucket
+        ]
+        if not candidates:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(candidates))
+
+    def nearest(self, vector: Any) -> float | None:
+        """Cosine distance to the closest indexed vector that shares a bucket"""
+        vector = self._normalize(vector)
+        candidates = self._candidates(self._codes(vector))
+        if not len(candidates):
+            return None
+        return float(1 - (self._vectors.values[candidates] @ vector).max())
+
+    def any_within(self, vector: Any, distance: float) -> bool:
+        """Is there any indexed vector at most `distance` cosine distance away,
+        approximately as only vectors sharing a bucket are compared"""
+        nearest = self.nearest(vector)
+        return nearest is not None and nearest <= distance
+
+    def add(self, vector: Any) -> None:
+        vector = self._normalize(vector)
+        index = len(self._vectors)
+        self._vectors.append(vector)
+        for bucket, code in zip(self._buckets, self._codes(vector)):
+            bucket.setdefault(code, []).append(index)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2024 Carnegie Mellon University
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+"""Filter, deduplicate, and split a dataset with a single import and export
+"""
+
+import argparse
+from pathlib import Path
+
+import datumaro as dm
+import yaml
+from datumaro.components.annotation import AnnotationType
+from tqdm import tqdm
+
+from .filter import (
+    RULE_KEYS,
+    AnnotationFilterTransform,
+    FilterRules,
+    attribute_equals,
+    load_rules,
+    parse_rule,
+)
+from .hashcache import DEFAULT_CACHE_FILE, HashCache
+from .unique import (
+    DEDUP_METHODS,
+    DedupTransform,
+    ImageHasher,
+    add_checker_arguments,
+    checker_options,
+    parse_cascade,
+)
+from .utils import datumaro_fixup
+
+DEFAULT_SPLITS = [("train", 0.9), ("val", 0.1)]
+
+
+def parse_split(spec):
+    """Parse a NAME:RATIO subset specification"""
+    name, _, ratio = spec.partition(":")
+    try:
+        return name, float(ratio)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid split {spec}") from None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-o", "--output", type=Path, default="split", help="Output dataset"
+    )
+
+    group = parser.add_argument_group("filter")
+    group.add_argument(
+        "--filter-occluded",
+        action="store_true",
+        help="Do not drop hidden or occluded annotations",
+    )
+    group.add_argument(
+        "--rules",
+        type=Path,
+        help="YAML or JSON file with annotation and frame filter rules",
+    )
+    group.add_argument(
+        "--rule",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help=f"Additional filter rule [{', '.join(sorted(RULE_KEYS))}]",
+    )
+
+    group = parser.add_argument_group("unique")
+    group.add_argument(
+        "-m",
+        "--method",
+        choices=DEDUP_METHODS,
+        default="sequential",
+        help="amount of effort spent to look for possible duplicates",
+    )
+    add_checker_arguments(group)
+    group.add_argument(
+        "--cascade",
+        metavar="STAGES",
+        help="Comma separated hash[:threshold] stages (defaults to phash)",
+    )
+    group.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of parallel processes used to compute image hashes",
+    )
+    group.add_argument(
+        "--cache-file",
+        type=Path,
+        default=DEFAULT_CACHE_FILE,
+        help=f"Persistent image hash cache (defaults to {DEFAULT_CACHE_FILE})",
+    )
+    group.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not use or update the persistent image hash cache",
+    )
+    group.add_argument(
+        "--full-decode",
+        action="store_true",
+        help="Hash full resolution images instead of a reduced resolution decode",
+    )
+
+    group = parser.add_argument_group("split")
+    group.add_argument(
+        "-s",
+        "--split",
+        type=parse_split,
+        action="append",
+        metavar="NAME:RATIO",
+        help="Randomly split into subsets (defaults to train:0.9 and val:0.1)",
+    )
+    group.add_argument(
+        "--no-split", action="store_true", help="Keep the original subsets"
+    )
+
+    parser.add_argument(
+        "--save-images",
+        action="store_true",
+        help="Copy images instead of only references for the output dataset",
+    )
+    parser.add_argument("dataset", type=Path, help="Input dataset")
+    args = parser.parse_args()
+
+    try:
+        rules = load_rules(args.rules) if args.rules else {}
+        rules.update(parse_rule(rule) for rule in args.rule)
+        cascade = parse_cascade(args.cascade or "phash", args.threshold)
+    except (OSError, ValueError, yaml.YAMLError) as exc:
+        parser.error(str(exc))
+
+    print("Importing", args.dataset)
+    datumaro_fixup(args.dataset)
+    dataset = dm.Dataset.import_from(str(args.dataset))
+    pre_len = len(dataset)
+
+    # the filter and dedup transforms are applied lazily and run only once,
+    # when the deduplicated dataset is materialized before the split
+    predicates = [attribute_equals("occluded", "False")] if args.filter_occluded else []
+    if rules:
+        labels = dataset.categories().get(AnnotationType.label)
+        try:
+            rules = FilterRules(rules, [label.name for label in labels or []])
+        except ValueError as exc:
+            parser.error(str(exc))
+    dataset.transform(
+        AnnotationFilterTransform, predicates=predicates, rules=rules or None
+    )
+
+    cache = None if args.no_cache else HashCache(args.cache_file)
+    hasher = ImageHasher(
+        args.jobs,
+        cache=cache,
+        reduced_decode=not args.full_decode,
+        algorithms=[algorithm for algorithm, _ in cascade],
+    )
+
+    with tqdm(unit="images") as pbar:
+        dataset.transform(
+            DedupTransform,
+            dedup_method=args.method,
+            cascade=cascade,
+            hasher=hasher,
+            progress=pbar,
+            **checker_options(args),
+        )
+        # random_split takes the length of its input before iterating it,
+        # which would otherwise filter and hash every image twice
+        post_len = len(dataset)
+
+        if not args.no_split:
+            dataset.transform(
+                "random_split", splits=args.split or DEFAULT_SPLITS, seed=args.seed
+            )
+
+        dataset.save(str(args.output), save_media=args.save_images)
+        datumaro_fixup(args.output)
+
+    if cache is not None:
+        cache.close()
+
+    subsets = ", ".join(
+        f"{len(subset)} {name}" for name, subset in sorted(dataset.subsets().items())
+    )
+    print(f"Kept {post_len} of {pre_len} images ({subsets})")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,19 +8,16 @@
 
 import os
 import shutil
-from pathlib import Path
 
 import requests
 from logzero import logger
 from tqdm import tqdm
 
+from ..xdg import XDG_CACHE_DIR
+
 # Registry to track available tensorflow detectors
 REGISTRY = {}
 
-XDG_CACHE_DIR = (
-    Path(os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))) / "opentpod-tools"
-)
-
 
 def get_cache_entry(entry_name):
     """returns path to entry in cache or None"""
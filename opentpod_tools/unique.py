@@ -13,24 +13,557 @@
 from __future__ import annotations
 
 import argparse
+import functools
+import itertools
+import json
+import math
+import os
 import random
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
 from pathlib import Path
 
 import datumaro as dm
 import imagehash
+import numpy as np
+import scipy.fftpack
 from datumaro.components.dataset_base import IDataset
 from datumaro.components.media import Image as dmImage
-from datumaro.components.transformer import ItemTransform
-from PIL import Image
+from datumaro.components.media import ImageFromFile
+from datumaro.components.transformer import ItemTransform, Transform
+from datumaro.util.image import load_image
+from PIL import Image, ImageOps
 from tqdm import tqdm
 
-from .utils import datumaro_fixup
+from .checkpoint import Checkpoint, checkpoint_path
+from .embedding import INPUT_SIZE, EmbeddingModel
+from .hashcache import (
+    DEFAULT_CACHE_FILE,
+    DEFAULT_EMBEDDING_CACHE_FILE,
+    EmbeddingCache,
+    HashCache,
+)
+from .hashindex import (
+    BKTree,
+    CosineLSHIndex,
+    GrowableArray,
+    HashArray,
+    ReferenceIndex,
+    hamming_distance,
+    hash_to_int,
+    popcount64,
+)
+from .utils import datumaro_fixup, import_dataset
 
 DIFF_THRESHOLD = 10
 DEFAULT_RATIO = 0.7
+DEFAULT_BUDGET = 100
+DEFAULT_RESERVOIR = 10000
+DEFAULT_WINDOW = 50
+DEFAULT_SEED = 0
 
+DEDUP_METHODS = ["sequential", "window", "random", "exhaustive"]
+
+# methods that only keep a bounded number of hashes, usable with --stream
+STREAM_METHODS = ["sequential", "window", "random", "annotations"]
+
+# representative image of a cluster of near-duplicates (cluster method)
+KEEP_POLICIES = ["first", "annotations", "area", "sharpness"]
+
+# minimum overlap of matching boxes in annotation-only dedup
+IOU_THRESHOLD = 0.9
+
+# maximum cosine distance between embeddings of near-duplicate images
+EMBEDDING_DISTANCE = 0.1
+
+# distances in the threshold sweep histograms
+HISTOGRAM_BINS = 32
+
+# number of images that are hashed together
+BATCH_SIZE = 32
+
+# number of batches queued per hashing worker
+PREFETCH_PER_JOB = 2
+
+# phash parameters, images are shrunk to THUMBNAIL_SIZE before the DCT
+HASH_SIZE = 8
+HIGHFREQ_FACTOR = 4
+THUMBNAIL_SIZE = HASH_SIZE * HIGHFREQ_FACTOR
+
+# hash algorithms that can be used in a cascade, phash is computed in batches
+HASH_FUNCTIONS = {
+    "ahash": imagehash.average_hash,
+    "dhash": imagehash.dhash,
+    "phash": None,
+    "whash": imagehash.whash,
+    "colorhash": imagehash.colorhash,
+}
+COLOR_HASHES = {"colorhash"}
+
+
+def _cache_key(algorithm, reduced_decode):
+    """Identifies a hash function in the persistent hash cache, decoding at a
+    reduced resolution results in slightly different hash values"""
+    return f"{algorithm}-draft" if reduced_decode else f"{algorithm}-full"
+
+
+def parse_cascade(spec, threshold=DIFF_THRESHOLD):
+    """Parse a comma separated list of algorithm[:threshold] cascade stages,
+    stages without an explicit threshold use the default threshold."""
+    stages = []
+    for stage in spec.split(","):
+        algorithm, _, stage_threshold = stage.strip().partition(":")
+        if algorithm not in HASH_FUNCTIONS:
+            raise ValueError(f"Unknown hash algorithm {algorithm}")
+        stages.append((algorithm, int(stage_threshold or threshold)))
+    return stages
+
+
+def _source_path(image):
+    """Path of the file backing an image, or None for in-memory media"""
+    if isinstance(image, str):
+        return image if os.path.isfile(image) else None
+    if isinstance(image, ImageFromFile) and os.path.isfile(image.path):
+        return image.path
+    return None
+
+
+def _source_data(image):
+    """Pixels of Datumaro media or an array of pixels"""
+    return image if isinstance(image, np.ndarray) else image.data
+
+
+def _open_reduced(path, mode, size=THUMBNAIL_SIZE):
+    """Open an image file for hashing, letting the decoder skip work by
+    directly producing an image in the requested mode that is only a few
+    times larger than the hash thumbnail (DCT scaling in the JPEG decoder)."""
+    image = Image.open(path)
+    image.draft(mode, (size, size))
+    return ImageOps.exif_transpose(image)
+
+
+def _from_bgr(data):
+    """Convert Datumaro image data (BGR channel order) to a PIL image"""
+    if data.dtype != np.uint8:
+        data = np.clip(data, 0, 255).astype(np.uint8)
+    if data.ndim == 3 and data.shape[2] == 3:
+        data = data[:, :, ::-1]
+    elif data.ndim == 3 and data.shape[2] == 4:
+        data = data[:, :, [2, 1, 0, 3]]
+    return Image.fromarray(np.ascontiguousarray(data))
+
+
+def _load_image_source(source, reduced_decode=True, color=False):
+    """Load an image file path or array of pixels, sources are either a path
+    or pixels so they can be sent to hashing workers."""
+    if not isinstance(source, str):
+        return _from_bgr(source)
+    if reduced_decode:
+        return _open_reduced(source, "RGB" if color else "L")
+    return _from_bgr(load_image(source))
+
+
+def _thumbnail(image):
+    """Shrink an image to the grayscale thumbnail used by phash"""
+    image = image.convert("L").resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.LANCZOS)
+    return np.asarray(image)
+
+
+def phash_batch(thumbnails):
+    """Compute perceptual hashes for a stack of grayscale thumbnails.
+
+    Takes an (N, THUMBNAIL_SIZE, THUMBNAIL_SIZE) array and returns an array of
+    N uint64 hashes that are bit-identical to imagehash.phash, the DCTs and
+    medians of the whole stack are computed with single vectorized calls.
+    """
+    pixels = np.asarray(thumbnails)
+    if not len(pixels):
+        return np.empty(0, dtype=np.uint64)
+
+    dct = scipy.fftpack.dct(scipy.fftpack.dct(pixels, axis=1), axis=2)
+    lowfreq = dct[:, :HASH_SIZE, :HASH_SIZE].reshape(len(pixels), -1)
+    median = np.median(lowfreq, axis=1, keepdims=True)
+
+    # pack row-major bits so the first bit ends up as the most significant
+    packed = np.packbits(lowfreq > median, axis=1)
+    return packed.view(">u8").ravel().astype(np.uint64)
+
+
+def _hash_image_sources(sources, algorithms=("phash",), reduced_decode=True):
+    """Compute a tuple of hashes, one for each algorithm, for a list of image
+    sources"""
+    color = not COLOR_HASHES.isdisjoint(algorithms)
+    grayscale = not COLOR_HASHES.issuperset(algorithms)
+    thumbnails, hashes = [], []
+    for source in sources:
+        image = gray = _load_image_source(source, reduced_decode, color)
+        if color and grayscale and reduced_decode and isinstance(source, str):
+            # converting a reduced color decode does not give exactly the same
+            # pixels as a grayscale decode, the grayscale hashes (and their
+            # cache entries) must not depend on the other hashes in a cascade
+            gray = _open_reduced(source, "L")
+        if "phash" in algorithms:
+            thumbnails.append(_thumbnail(gray))
+        hashes.append(
+            {
+                algorithm: hash_to_int(
+                    HASH_FUNCTIONS[algorithm](
+                        image if algorithm in COLOR_HASHES else gray
+                    )
+                )
+                for algorithm in algorithms
+                if algorithm != "phash"
+            }
+        )
+
+    if thumbnails:
+        for image_hashes, phash in zip(hashes, phash_batch(np.stack(thumbnails))):
+            image_hashes["phash"] = int(phash)
+
+    return [
+        tuple(image_hashes[algorithm] for algorithm in algorithms)
+        for image_hashes in hashes
+    ]
+
+
+def _hash_image_source(source, reduced_decode=True):
+    """Compute the phash of a single image source"""
+    return _hash_image_sources([source], reduced_decode=reduced_decode)[0][0]
+
+
+class WindowChecker:
+    """Compare against the last `window` kept hashes"""
+
+    def __init__(self, threshold: int, window: int = DEFAULT_WINDOW):
+        self._radius = threshold - 1
+        self._hashes = np.zeros(max(window, 1), dtype=np.uint64)
+        self._keys = np.zeros(max(window, 1), dtype=np.int64)
+        self._kept = 0
+
+    def is_duplicate(self, image_hash: int) -> bool:
+        hashes = self._hashes[: self._kept]
+        return bool((popcount64(hashes ^ np.uint64(image_hash)) <= self._radius).any())
+
+    def candidates(self, image_hash: int) -> np.ndarray:
+        hashes = self._hashes[: self._kept]
+        matches = popcount64(hashes ^ np.uint64(image_hash)) <= self._radius
+        return self._keys[: self._kept][matches]
+
+    def nearest(self, image_hash: int, limit: int) -> int | None:
+        hashes = self._hashes[: self._kept]
+        if not len(hashes):
+            return None
+        distance = int(popcount64(hashes ^ np.uint64(image_hash)).min())
+        return distance if distance <= limit else None
+
+    def add(self, image_hash: int) -> None:
+        slot = self._kept % len(self._hashes)
+        self._hashes[slot] = image_hash
+        self._keys[slot] = self._kept
+        self._kept += 1
+
+
+class RandomChecker:
+    """Compare against the last kept hash and a random sample of earlier ones.
+
+    The sample is drawn from a reservoir which holds a uniform random subset
+    of at most `reservoir` kept hashes, each image is compared against at most
+    `budget` hashes so time and memory per image are bounded.
+    """
+
+    def __init__(
+        self,
+        threshold: int,
+        ratio: float = DEFAULT_RATIO,
+        budget: int = DEFAULT_BUDGET,
+        reservoir: int = DEFAULT_RESERVOIR,
+        seed: int | None = DEFAULT_SEED,
+    ):
+        self._radius = threshold - 1
+        self._ratio = ratio
+        self._budget = max(budget, 1)
+        self._reservoir = HashArray()
+        self._reservoir_keys = GrowableArray(np.int64)
+        self._capacity = max(reservoir, 1)
+        self._last: int | None = None
+        self._kept = 0
+        self._random = random.Random(seed)
+
+    def is_duplicate(self, image_hash: int) -> bool:
+        if self._last is None:
+            return False
+        if hamming_distance(image_hash, self._last) <= self._radius:
+            return True
+
+        sample = self._draw_sample()
+        return self._reservoir.any_within(image_hash, self._radius, sample)
+
+    def _draw_sample(self) -> list[int]:
+        k = min(self._budget - 1, math.ceil(len(self._reservoir) * self._ratio))
+        if k <= 0:
+            return []
+        return self._random.sample(range(len(self._reservoir)), k)
+
+    def candidates(self, image_hash: int) -> np.ndarray:
+        if self._last is None:
+            return np.empty(0, dtype=np.int64)
+
+        found = []
+        if hamming_distance(image_hash, self._last) <= self._radius:
+            found.append(self._kept)
+
+        sample = self._draw_sample()
+        if sample:
+            matches = self._reservoir.distances(image_hash, sample) <= self._radius
+            found.extend(self._reservoir_keys.values[sample][matches])
+        return np.array(found, dtype=np.int64)
+
+    def nearest(self, image_hash: int, limit: int) -> int | None:
+        # considers the whole reservoir to not disturb the random sequence
+        if self._last is None:
+            return None
+        distance = hamming_distance(image_hash, self._last)
+        if len(self._reservoir):
+            distance = min(distance, int(self._reservoir.distances(image_hash).min()))
+        return distance if distance <= limit else None
+
+    def add(self, image_hash: int) -> None:
+        if self._last is not None:
+            self._sample(self._last)
+        self._last = image_hash
+
+    def _sample(self, image_hash: int) -> None:
+        # reservoir sampling (algorithm R) over all but the last kept hash,
+        # the key of a hash is its index in the sequence of kept hashes
+        key = self._kept
+        self._kept += 1
+        if len(self._reservoir) < self._capacity:
+            self._reservoir.append(image_hash)
+            self._reservoir_keys.append(key)
+            return
+        slot = self._random.randrange(self._kept)
+        if slot < self._capacity:
+            self._reservoir.values[slot] = image_hash
+            self._reservoir_keys.values[slot] = key
+
+
+class ExhaustiveChecker:
+    """Compare against all kept hashes"""
+
+    def __init__(self, threshold: int):
+        self._radius = threshold - 1
+        self._index = BKTree()
+
+    def is_duplicate(self, image_hash: int) -> bool:
+        return self._index.any_within(image_hash, self._radius)
+
+    def nearest(self, image_hash: int, limit: int) -> int | None:
+        return self._index.nearest(image_hash, limit)
+
+    def candidates(self, image_hash: int) -> np.ndarray:
+        return np.array(self._index.find_within(image_hash, self._radius), np.int64)
+
+    def add(self, image_hash: int) -> None:
+        self._index.add(image_hash)
+
+
+def make_checker(
+    method: str,
+    threshold: int = DIFF_THRESHOLD,
+    ratio: float = DEFAULT_RATIO,
+    budget: int = DEFAULT_BUDGET,
+    reservoir: int = DEFAULT_RESERVOIR,
+    window: int = DEFAULT_WINDOW,
+    seed: int | None = DEFAULT_SEED,
+):
+    """Create the duplicate checker for a comparison method, hashes that
+    differ in less than 'threshold' bits are considered similar."""
+    if method == "sequential":
+        return WindowChecker(threshold, 1)
+    if method == "window":
+        return WindowChecker(threshold, window)
+    if method == "random":
+        return RandomChecker(threshold, ratio, budget, reservoir, seed)
+    if method == "exhaustive":
+        return ExhaustiveChecker(threshold)
+    raise ValueError(f"Unknown dedup method {method}")
+
+
+class CascadeChecker:
+    """Compare a tuple of hashes per image in stages.
+
+    The comparison method only looks at the first, cheap, hash to find the
+    kept images that are candidate duplicates. Candidates are then confirmed
+    with each of the following hashes and their own thresholds, an image is
+    only a duplicate when some kept image passes every stage.
+    """
+
+    def __init__(self, checker, thresholds=()):
+        self._checker = checker
+        self._radii = [threshold - 1 for threshold in thresholds]
+        self._stages = [HashArray() for _ in thresholds]
+
+    def is_duplicate(self, hashes) -> bool:
+        if not self._stages:
+            return self._checker.is_duplicate(hashes[0])
+
+        candidates = self._checker.candidates(hashes[0])
+        for stage, radius, image_hash in zip(self._stages, self._radii, hashes[1:]):
+            if not len(candidates):
+                break
+            candidates = candidates[stage.distances(image_hash, candidates) <= radius]
+        return bool(len(candidates))
+
+    def add(self, hashes) -> None:
+        self._checker.add(hashes[0])
+        for stage, image_hash in zip(self._stages, hashes[1:]):
+            stage.append(image_hash)
+
+
+def make_cascade_checker(method: str, cascade, **checker_options):
+    """Create a checker for a list of (algorithm, threshold) stages"""
+    thresholds = [threshold for _, threshold in cascade]
+    checker = make_checker(method, thresholds[0], **checker_options)
+    return CascadeChecker(checker, thresholds[1:])
+
+
+def _batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class ImageHasher:
+    """Computes image hashes for a stream of dataset items.
+
+    Every item is hashed with each of the hash algorithms, resulting in a
+    tuple of integer hashes. Items are hashed in batches, optionally by a
+    pool of worker processes that runs a few batches ahead, while the results
+    are returned in the original order. Hashes of file backed images are
+    stored in the optional persistent hash cache.
+    """
+
+    def __init__(
+        self,
+        jobs: int = 1,
+        batch_size: int = BATCH_SIZE,
+        cache: HashCache | str | None = None,
+        reduced_decode: bool = True,
+        algorithms=("phash",),
+    ):
+        self._jobs = jobs
+        self._batch_size = max(batch_size, 1)
+        if isinstance(cache, (str, Path)):
+            cache = HashCache(cache)
+        self._cache = cache
+        self._reduced_decode = reduced_decode
+        self._algorithms = tuple(algorithms)
+        self._cache_keys = [
+            _cache_key(algorithm, reduced_decode) for algorithm in self._algorithms
+        ]
+
+    def _cached_hash(self, image):
+        path = _source_path(image)
+        if self._cache is None or path is None:
+            return path, None
+
+        hashes = tuple(self._cache.get(path, key) for key in self._cache_keys)
+        return path, None if None in hashes else hashes
+
+    def _store_hash(self, path, hashes):
+        if self._cache is not None and path is not None:
+            for key, image_hash in zip(self._cache_keys, hashes):
+                self._cache.put(path, key, image_hash)
+
+    def _batches(self, items):
+        return _batches(items, self._batch_size)
+
+    def _lookup(self, batch):
+        """Find cached hashes and collect the sources of images that still
+        have to be hashed"""
+        entries, sources = [], []
+        for key, image in batch:
+            path, image_hash = self._cached_hash(image)
+            if image_hash is None:
+                sources.append(path if path is not None else _source_data(image))
+            entries.append((key, path, image_hash))
+        return entries, sources
+
+    def _resolve(self, entries, hashes):
+        hashes = iter(hashes)
+        for key, path, image_hash in entries:
+            if image_hash is None:
+                image_hash = next(hashes)
+                self._store_hash(path, image_hash)
+            yield key, image_hash
+
+    def _prefetch_hashes(self, images):
+        """Yield (key, hash) in dataset order while a pool of worker
+        processes computes the hashes of the next few batches."""
+        window = deque()
+        max_pending = self._jobs * PREFETCH_PER_JOB
+
+        with ProcessPoolExecutor(max_workers=self._jobs) as pool:
+            try:
+                for batch in self._batches(images):
+                    entries, sources = self._lookup(batch)
+                    pending = pool.submit(
+                        _hash_image_sources,
+                        sources,
+                        self._algorithms,
+                        self._reduced_decode,
+                    )
+                    window.append((entries, pending))
+
+                    if len(window) >= max_pending:
+                        entries, pending = window.popleft()
+                        yield from self._resolve(entries, pending.result())
+
+                while window:
+                    entries, pending = window.popleft()
+                    yield from self._resolve(entries, pending.result())
+            finally:
+                for _, pending in window:
+                    pending.cancel()
+
+    def hash_images(self, images):
+        """Yield (key, hash) in order for an iterable of (key, image) pairs,
+        where an image is Datumaro media, a file path, or an array of pixels"""
+        try:
+            if self._jobs > 1:
+                yield from self._prefetch_hashes(images)
+                return
+
+            for batch in self._batches(images):
+                entries, sources = self._lookup(batch)
+                hashes = _hash_image_sources(
+                    sources, self._algorithms, self._reduced_decode
+                )
+                yield from self._resolve(entries, hashes)
+        finally:
+            if self._cache is not None:
+                self._cache.flush()
+
+    def hash_items(self, items):
+        """Yield (item, hash) for all dataset items in order"""
+        images = ((item, item.media_as(dmImage)) for item in items)
+        return self.hash_images(images)
+
+
+class DedupTransform(Transform):
+    """Drop images that are similar to an earlier kept image.
+
+    This is not an ItemTransform, Datumaro passes those one item at a time
+    to transform_item, the items are instead pulled through __iter__ so
+    images can be hashed ahead by the worker processes.
+    """
 
-class DedupTransform(ItemTransform):
     @classmethod
     def build_cmdline_parser(cls, **kwargs):
         parser = super().build_cmdline_parser(**kwargs)
@@ -39,7 +572,7 @@ class DedupTransform(ItemTransform):
             dest="dedup_method",
             type=str,
             default="sequential",
-            help="Comparison method [sequential, random, exhaustive]",
+            help="Comparison method [sequential, window, random, exhaustive]",
         )
         parser.add_argument(
             "--threshold",
@@ -55,6 +588,81 @@ class DedupTransform(ItemTransform):
             default=DEFAULT_RATIO,
             help="Ratio for random sample size to check against",
         )
+        parser.add_argument(
+            "--budget",
+            dest="budget",
+            type=int,
+            default=DEFAULT_BUDGET,
+            help="Maximum number of comparisons per image for the random method",
+        )
+        parser.add_argument(
+            "--reservoir",
+            dest="reservoir",
+            type=int,
+            default=DEFAULT_RESERVOIR,
+            help="Number of kept hashes the random method samples from",
+        )
+        parser.add_argument(
+            "--window",
+            dest="window",
+            type=int,
+            default=DEFAULT_WINDOW,
+            help="Number of recently kept hashes for the window method",
+        )
+        parser.add_argument(
+            "--seed",
+            dest="seed",
+            type=int,
+            default=DEFAULT_SEED,
+            help="Random seed for the random method",
+        )
+        parser.add_argument(
+            "--jobs",
+            dest="jobs",
+            type=int,
+            default=1,
+            help="Number of worker processes computing image hashes",
+        )
+        parser.add_argument(
+            "--batch-size",
+            dest="batch_size",
+            type=int,
+            default=BATCH_SIZE,
+            help="Number of images hashed together",
+        )
+        parser.add_argument(
+            "--cache-file",
+            dest="cache",
+            type=str,
+            default=None,
+            help="SQLite file used to cache image hashes between runs",
+        )
+        parser.add_argument(
+            "--full-decode",
+            dest="reduced_decode",
+            action="store_false",
+            help="Decode images at full resolution before hashing",
+        )
+        parser.add_argument(
+            "--cascade",
+            dest="cascade",
+            type=str,
+            default=None,
+            help="Comma separated hash[:threshold] stages, e.g. dhash:16,phash:10",
+        )
+        parser.add_argument(
+            "--reference-index",
+            dest="reference",
+            type=str,
+            default=None,
+            help="Also drop images that are similar to hashes in this index",
+        )
+        parser.add_argument(
+            "--update-reference",
+            dest="update_reference",
+            action="store_true",
+            help="Append the hashes of kept images to the reference index",
+        )
         return parser
 
     def __init__(
@@ -63,46 +671,816 @@ class DedupTransform(ItemTransform):
         dedup_method: str = "sequential",
         threshold: int = DIFF_THRESHOLD,
         ratio: float = DEFAULT_RATIO,
+        budget: int = DEFAULT_BUDGET,
+        reservoir: int = DEFAULT_RESERVOIR,
+        window: int = DEFAULT_WINDOW,
+        seed: int | None = DEFAULT_SEED,
+        jobs: int = 1,
+        batch_size: int = BATCH_SIZE,
+        cache: HashCache | str | None = None,
+        reduced_decode: bool = True,
+        cascade: str | list[tuple[str, int]] | None = None,
+        reference: ReferenceIndex | str | None = None,
+        update_reference: bool = False,
+        hasher: ImageHasher | None = None,
         progress=None,
     ):
         super().__init__(extractor)
-        self._method = dedup_method
-        self._threshold = threshold
-        self._ratio = ratio
-        self._deduped = []
+        if cascade is None:
+            cascade = [("phash", threshold)]
+        elif isinstance(cascade, str):
+            cascade = parse_cascade(cascade, threshold)
+        algorithms = [algorithm for algorithm, _ in cascade]
+
+        self._make_checker = functools.partial(
+            make_cascade_checker,
+            dedup_method,
+            cascade,
+            ratio=ratio,
+            budget=budget,
+            reservoir=reservoir,
+            window=window,
+            seed=seed,
+        )
+        self._checker = self._make_checker()
+        if hasher is None:
+            hasher = ImageHasher(
+                jobs, batch_size, cache, reduced_decode, algorithms=algorithms
+            )
+        self._hasher = hasher
+
+        # an index passed in is flushed by the caller once the run completes
+        self._owns_reference = isinstance(reference, (str, Path))
+        if self._owns_reference:
+            reference = ReferenceIndex(reference, algorithms[0], reduced_decode)
+        self._reference = reference
+        self._update_reference = update_reference
+        if reference is not None:
+            if reference.algorithm not in algorithms:
+                raise ValueError(
+                    f"Reference index contains {reference.algorithm} hashes"
+                )
+            if reference.reduced_decode not in (None, reduced_decode):
+                raise ValueError("Reference index was hashed with a different decode")
+            self._reference_stage = algorithms.index(reference.algorithm)
+            self._reference_radius = cascade[self._reference_stage][1] - 1
+
         self._progress = progress
 
-    @staticmethod
-    def _compute_image_hash(image):
-        im = Image.fromarray(image.data)
-        return imagehash.phash(im)
+    def _in_reference(self, hashes):
+        if self._reference is None:
+            return False
+        image_hash = hashes[self._reference_stage]
+        return self._reference.any_within(image_hash, self._reference_radius)
+
+    def is_duplicate(self, hashes):
+        return self._checker.is_duplicate(hashes)
+
+    def __iter__(self):
+        # stream datasets are iterated more than once, so every pass starts
+        # from scratch to make the same selection
+        self._checker = self._make_checker()
+        if self._progress is not None:
+            self._progress.reset()
+        for item, hashes in self._hasher.hash_items(self._extractor):
+            item = self._select(item, hashes)
+            if item is not None:
+                yield item
+
+        if self._update_reference and self._owns_reference:
+            self._reference.flush()
+
+    def _select(self, item, hashes):
+        if self._progress is not None:
+            self._progress.update()
+
+        if self.is_duplicate(hashes) or self._in_reference(hashes):
+            return None
+
+        self._checker.add(hashes)
+        if self._update_reference:
+            self._reference.append(hashes[self._reference_stage])
+        return item
+
+
+class CheckpointHasher:
+    """Records the hashes computed by an ImageHasher in a checkpoint.
+
+    When resuming, the recorded hashes are returned for the already
+    processed items at the start of the dataset, and only the remaining
+    items are hashed. Replaying the recorded hashes through a checker
+    reproduces its state, so the resumed run makes the same selection.
+    """
+
+    def __init__(self, hasher: ImageHasher, checkpoint: Checkpoint):
+        self._hasher = hasher
+        self._checkpoint = checkpoint
+
+    def hash_items(self, items):
+        items = iter(items)
+        for item in items:
+            hashes = self._checkpoint.get((item.id, item.subset))
+            if hashes is None:
+                items = itertools.chain([item], items)
+                break
+            yield item, tuple(int(image_hash, 16) for image_hash in hashes)
+
+        try:
+            for item, hashes in self._hasher.hash_items(items):
+                self._checkpoint.put(
+                    (item.id, item.subset), [f"{image_hash:x}" for image_hash in hashes]
+                )
+                yield item, hashes
+        finally:
+            self._checkpoint.flush()
+
+
+def _load_embedding_image(image, reduced_decode=True):
+    """Load Datumaro media for the embedding model, JPEG files are decoded at
+    a reduced resolution close to the model input size"""
+    path = _source_path(image)
+    if path is None:
+        return _from_bgr(_source_data(image))
+    if reduced_decode:
+        return _open_reduced(path, "RGB", INPUT_SIZE)
+    return _from_bgr(load_image(path))
+
+
+class ImageEmbedder:
+    """Computes CNN embeddings for a stream of dataset items.
+
+    Images are decoded and run through the model in batches, embeddings of
+    file backed images are stored in the optional persistent cache.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = BATCH_SIZE,
+        cache: EmbeddingCache | str | None = None,
+        reduced_decode: bool = True,
+        model: EmbeddingModel | None = None,
+    ):
+        self._model = model if model is not None else EmbeddingModel()
+        self._batch_size = max(batch_size, 1)
+        if isinstance(cache, (str, Path)):
+            cache = EmbeddingCache(cache)
+        self._cache = cache
+        self._reduced_decode = reduced_decode
+        self._cache_key = _cache_key(self._model.name, reduced_decode)
 
     @property
-    def check_list(self):
-        if self._method == "sequential":
-            return self._deduped[-1:]
+    def dim(self):
+        return self._model.dim
 
-        elif self._method == "exhaustive":
-            return self._deduped
+    def _cached_embedding(self, path):
+        if self._cache is None or path is None:
+            return None
+        return self._cache.get(path, self._cache_key)
 
-        else:  # self._method == "random":
-            k = len(self._deduped) * self._ratio
-            return random.sample(self._deduped, k)
+    def embed_items(self, items):
+        """Yield (item, embedding) for all dataset items in order"""
+        try:
+            for batch in _batches(items, self._batch_size):
+                entries, images = [], []
+                for item in batch:
+                    image = item.media_as(dmImage)
+                    path = _source_path(image)
+                    embedding = self._cached_embedding(path)
+                    if embedding is None:
+                        images.append(
+                            _load_embedding_image(image, self._reduced_decode)
+                        )
+                    entries.append((item, path, embedding))
+
+                embeddings = iter(self._model(images))
+                for item, path, embedding in entries:
+                    if embedding is None:
+                        embedding = next(embeddings)
+                        if self._cache is not None and path is not None:
+                            self._cache.put(path, self._cache_key, embedding)
+                    yield item, embedding
+        finally:
+            if self._cache is not None:
+                self._cache.flush()
+
+
+class EmbeddingDedupTransform(Transform):
+    """Drop images whose CNN embedding is within a cosine distance of any
+    kept image, candidates are found with an approximate nearest neighbour
+    (random hyperplane LSH) index.
+
+    Like DedupTransform, the items are pulled through the embedder so that
+    images are run through the model in batches.
+    """
+
+    @classmethod
+    def build_cmdline_parser(cls, **kwargs):
+        parser = super().build_cmdline_parser(**kwargs)
+        parser.add_argument(
+            "--distance",
+            type=float,
+            default=EMBEDDING_DISTANCE,
+            help="Maximum cosine distance between near-duplicate images",
+        )
+        parser.add_argument(
+            "--batch-size",
+            dest="batch_size",
+            type=int,
+            default=BATCH_SIZE,
+            help="Number of images embedded together",
+        )
+        parser.add_argument(
+            "--cache-file",
+            dest="cache",
+            type=str,
+            default=None,
+            help="SQLite file used to cache image embeddings between runs",
+        )
+        parser.add_argument(
+            "--full-decode",
+            dest="reduced_decode",
+            action="store_false",
+            help="Decode images at full resolution",
+        )
+        return parser
+
+    def __init__(
+        self,
+        extractor: IDataset,
+        distance: float = EMBEDDING_DISTANCE,
+        batch_size: int = BATCH_SIZE,
+        cache: EmbeddingCache | str | None = None,
+        reduced_decode: bool = True,
+        seed: int | None = DEFAULT_SEED,
+        embedder: ImageEmbedder | None = None,
+        progress=None,
+    ):
+        super().__init__(extractor)
+        if embedder is None:
+            embedder = ImageEmbedder(batch_size, cache, reduced_decode)
+        self._embedder = embedder
+        self._seed = seed
+        self._distance = distance
+        self._progress = progress
+
+    def __iter__(self):
+        # start from an empty index on every pass, as in DedupTransform
+        self._index = CosineLSHIndex(self._embedder.dim, seed=self._seed)
+        for item, embedding in self._embedder.embed_items(self._extractor):
+            item = self._select(item, embedding)
+            if item is not None:
+                yield item
+
+    def _select(self, item, embedding):
+        if self._progress is not None:
+            self._progress.update()
+
+        if self._index.any_within(embedding, self._distance):
+            return None
+
+        self._index.add(embedding)
+        return item
+
+
+def _annotation_boxes(item):
+    """Labels and (x1, y1, x2, y2) bounding boxes of the item's annotations"""
+    annotations = [
+        annotation
+        for annotation in item.annotations
+        if hasattr(annotation, "get_bbox") and annotation.label is not None
+    ]
+    labels = np.array([annotation.label for annotation in annotations], dtype=int)
+    boxes = np.array(
+        [annotation.get_bbox() for annotation in annotations], dtype=np.float64
+    ).reshape(-1, 4)
+    boxes[:, 2:] += boxes[:, :2]
+    return labels, boxes
 
-    def transform_item(self, item):
-        image_hash = self._compute_image_hash(item.media_as(dmImage))
 
+def box_iou(boxes, others):
+    """Matrix of intersection over union of two arrays of (x1, y1, x2, y2)"""
+    top_left = np.maximum(boxes[:, None, :2], others[None, :, :2])
+    bottom_right = np.minimum(boxes[:, None, 2:], others[None, :, 2:])
+    intersection = np.clip(bottom_right - top_left, 0, None).prod(axis=2)
+
+    area = (boxes[:, 2:] - boxes[:, :2]).prod(axis=1)
+    other_area = (others[:, 2:] - others[:, :2]).prod(axis=1)
+    union = area[:, None] + other_area[None, :] - intersection
+    return np.divide(
+        intersection, union, out=np.zeros_like(intersection), where=union > 0
+    )
+
+
+class AnnotationDedupTransform(ItemTransform):
+    """Drop frames that carry the same labels at nearly the same boxes as the
+    last kept frame of the same subset, without loading any media.
+
+    A frame is a duplicate when it has as many annotations of each label as
+    the last kept frame, and every box overlaps a box with the same label in
+    the other frame by at least the IoU threshold. Frames without boxes are
+    always kept, there is nothing to compare them by.
+    """
+
+    @classmethod
+    def build_cmdline_parser(cls, **kwargs):
+        parser = super().build_cmdline_parser(**kwargs)
+        parser.add_argument(
+            "--iou",
+            type=float,
+            default=IOU_THRESHOLD,
+            help="Minimum overlap of boxes with the same label",
+        )
+        return parser
+
+    def __init__(self, extractor: IDataset, iou: float = IOU_THRESHOLD, progress=None):
+        super().__init__(extractor)
+        self._iou = iou
+        self._kept = {}
+        self._progress = progress
+
+    def __iter__(self):
+        self._kept = {}
+        return super().__iter__()
+
+    def is_duplicate(self, labels, boxes, kept_labels, kept_boxes) -> bool:
+        if len(labels) != len(kept_labels):
+            return False
+        if not np.array_equal(np.sort(labels), np.sort(kept_labels)):
+            return False
+        if not len(labels):
+            return False
+
+        iou = box_iou(boxes, kept_boxes)
+        iou[labels[:, None] != kept_labels[None, :]] = 0
+        matches = iou >= self._iou
+        return bool(matches.any(axis=1).all() and matches.any(axis=0).all())
+
+    def transform_item(self, item):
         if self._progress is not None:
             self._progress.update()
 
-        for check_hash in self.check_list:
-            if (image_hash - check_hash) < self._threshold:
-                return None
+        labels, boxes = _annotation_boxes(item)
+        kept = self._kept.get(item.subset)
+        if kept is not None and self.is_duplicate(labels, boxes, *kept):
+            return None
 
-        self._deduped.append(image_hash)
+        self._kept[item.subset] = labels, boxes
         return item
 
 
+class SelectItemsTransform(ItemTransform):
+    """Only keep the dataset items with the given (id, subset) keys"""
+
+    def __init__(self, extractor: IDataset, keep):
+        super().__init__(extractor)
+        self._keep = set(keep)
+
+    def transform_item(self, item):
+        if (item.id, item.subset) in self._keep:
+            return item
+        return None
+
+
+def partition_key(spec: str):
+    """Return a function that maps dataset items to a partition key, by
+    'subset', id 'prefix' (everything up to the last '/'), or 'attr:NAME'."""
+    if spec == "subset":
+        return lambda item: item.subset
+    if spec == "prefix":
+        return lambda item: item.id.rpartition("/")[0]
+    if spec.startswith("attr:"):
+        name = spec[len("attr:") :]
+        return lambda item: str(item.attributes.get(name))
+    raise ValueError(f"Unknown partition key {spec}")
+
+
+def _dedup_partition(entries, method, cascade, checker_options, reduced_decode):
+    """Deduplicate a list of (key, image source, cached hashes) entries in a
+    worker process. Returns the keys of the kept images and the hashes that
+    had to be computed, which are stored in the hash cache by the parent so
+    the workers do not compete for the database lock."""
+    checker = make_cascade_checker(method, cascade, **checker_options)
+    hasher = ImageHasher(
+        algorithms=[algorithm for algorithm, _ in cascade],
+        reduced_decode=reduced_decode,
+    )
+    missing = hasher.hash_images(
+        (key, source) for key, source, hashes in entries if hashes is None
+    )
+
+    kept, computed = [], []
+    for key, _, hashes in entries:
+        if hashes is None:
+            _, hashes = next(missing)
+            computed.append((key, hashes))
+        if not checker.is_duplicate(hashes):
+            checker.add(hashes)
+            kept.append(key)
+    return kept, computed
+
+
+def partitioned_dedup(
+    items,
+    key,
+    method,
+    cascade,
+    jobs=1,
+    checker_options=None,
+    cache=None,
+    reduced_decode=True,
+    progress=None,
+):
+    """Group items by a partition key and deduplicate each partition, in
+    dataset order, in a pool of worker processes. Returns the (id, subset)
+    keys of all kept items.
+
+    Only this process uses the hash cache, cached hashes are sent along with
+    the images and new hashes are returned by the workers.
+    """
+    hasher = ImageHasher(
+        cache=cache,
+        reduced_decode=reduced_decode,
+        algorithms=[algorithm for algorithm, _ in cascade],
+    )
+    partitions, paths = {}, {}
+    for item in items:
+        image = item.media_as(dmImage)
+        path, hashes = hasher._cached_hash(image)
+        source = path if path is not None else _source_data(image)
+        item_key = (item.id, item.subset)
+        paths[item_key] = path
+        partitions.setdefault(key(item), []).append((item_key, source, hashes))
+
+    kept = set()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        pending = {
+            pool.submit(
+                _dedup_partition,
+                entries,
+                method,
+                cascade,
+                checker_options or {},
+                reduced_decode,
+            ): len(entries)
+            for entries in partitions.values()
+        }
+        for done in as_completed(pending):
+            partition_kept, computed = done.result()
+            kept.update(partition_kept)
+            for item_key, hashes in computed:
+                hasher._store_hash(paths[item_key], hashes)
+            if progress is not None:
+                progress.update(pending[done])
+
+    if cache is not None:
+        cache.flush()
+    return kept
+
+
+def _find(parent, index):
+    """Root of the disjoint set containing index, with path halving"""
+    while parent[index] != index:
+        parent[index] = parent[parent[index]]
+        index = parent[index]
+    return index
+
+
+def _annotated_area(item):
+    return sum(
+        annotation.get_area()
+        for annotation in item.annotations
+        if hasattr(annotation, "get_area")
+    )
+
+
+def _sharpness(source, reduced_decode=True):
+    """Variance of the Laplacian of an image, blurry images score low"""
+    image = _load_image_source(source, reduced_decode)
+    pixels = np.asarray(image.convert("L"), dtype=np.float32)
+    laplacian = (
+        pixels[:-2, 1:-1]
+        + pixels[2:, 1:-1]
+        + pixels[1:-1, :-2]
+        + pixels[1:-1, 2:]
+        - 4 * pixels[1:-1, 1:-1]
+    )
+    return float(laplacian.var()) if laplacian.size else 0.0
+
+
+def cluster_dedup(
+    items, hasher, cascade, policy="first", jobs=1, reduced_decode=True, progress=None
+):
+    """Group near-duplicate items into clusters and keep a single
+    representative of each cluster. Returns the (id, subset) keys of the kept
+    items.
+
+    Every image is linked to all earlier images that pass each stage of the
+    cascade, found with a BK-tree over the first hash, and linked images are
+    merged with union-find. As linking is transitive a slowly changing scene
+    can end up as a single cluster. The representative is the item with the
+    most annotations, the largest annotated area, the sharpest image, or the
+    first item of the cluster.
+    """
+    if policy not in KEEP_POLICIES:
+        raise ValueError(f"Unknown keep policy {policy}")
+
+    radii = [threshold - 1 for _, threshold in cascade]
+    tree = BKTree()
+    stages = [HashArray() for _ in cascade[1:]]
+    parent, keys, sources = [], [], []
+    scores = GrowableArray(np.float64)
+
+    for index, (item, hashes) in enumerate(hasher.hash_items(items)):
+        parent.append(index)
+        candidates = np.array(tree.find_within(hashes[0], radii[0]), dtype=np.int64)
+        for stage, radius, image_hash in zip(stages, radii[1:], hashes[1:]):
+            if not len(candidates):
+                break
+            candidates = candidates[stage.distances(image_hash, candidates) <= radius]
+
+        for other in candidates:
+            root, other_root = _find(parent, index), _find(parent, int(other))
+            parent[max(root, other_root)] = min(root, other_root)
+
+        tree.add(hashes[0])
+        for stage, image_hash in zip(stages, hashes[1:]):
+            stage.append(image_hash)
+
+        keys.append((item.id, item.subset))
+        if policy == "annotations":
+            scores.append(len(item.annotations))
+        elif policy == "area":
+            scores.append(_annotated_area(item))
+        else:
+            scores.append(0)
+
+        if policy == "sharpness":
+            image = item.media_as(dmImage)
+            path = _source_path(image)
+            sources.append(path if path is not None else image)
+
+        if progress is not None:
+            progress.update()
+
+    roots = np.array(
+        [_find(parent, index) for index in range(len(keys))], dtype=np.int64
+    )
+    scores = scores.values
+
+    # only images that have near-duplicates have to be decoded again
+    if policy == "sharpness" and len(keys):
+        clustered = np.flatnonzero(np.bincount(roots)[roots] > 1)
+        clustered_sources = [
+            source if isinstance(source, str) else _source_data(source)
+            for source in (sources[index] for index in clustered)
+        ]
+        if jobs > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                sharpness = list(
+                    pool.map(
+                        _sharpness,
+                        clustered_sources,
+                        [reduced_decode] * len(clustered_sources),
+                        chunksize=BATCH_SIZE,
+                    )
+                )
+        else:
+            sharpness = [
+                _sharpness(source, reduced_decode) for source in clustered_sources
+            ]
+        scores[clustered] = sharpness
+
+    # order by cluster, best score first, and earliest item on a tie
+    order = np.lexsort((np.arange(len(keys)), -scores, roots))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = roots[order][1:] != roots[order][:-1]
+    return {keys[index] for index in order[first]}
+
+
+@dataclass
+class SweepResult:
+    method: str
+    threshold: int
+    kept: list = field(default_factory=list)
+    histogram: np.ndarray = field(
+        default_factory=lambda: np.zeros(HISTOGRAM_BINS + 1, dtype=np.int64)
+    )
+
+    @property
+    def name(self):
+        return f"{self.method}-t{self.threshold}"
+
+
+def sweep(items, hasher, methods, thresholds, progress=None, **checker_options):
+    """Deduplicate with several methods and thresholds from a single hashing
+    pass over the items. Also collects, for every variant, a histogram of the
+    distance between each image and the nearest hash it is compared against,
+    distances beyond HISTOGRAM_BINS are counted in the last bin."""
+    variants = [
+        (
+            SweepResult(method, threshold),
+            make_checker(method, threshold, **checker_options),
+        )
+        for method in methods
+        for threshold in thresholds
+    ]
+
+    for item, (image_hash,) in hasher.hash_items(items):
+        for result, checker in variants:
+            distance = checker.nearest(image_hash, HISTOGRAM_BINS - 1)
+            result.histogram[HISTOGRAM_BINS if distance is None else distance] += 1
+
+            if not checker.is_duplicate(image_hash):
+                checker.add(image_hash)
+                result.kept.append((item.id, item.subset))
+
+        if progress is not None:
+            progress.update()
+
+    return [result for result, _ in variants]
+
+
+def _print_histogram(histogram, width=50):
+    scale = width / max(histogram.max(), 1)
+    for distance, count in enumerate(histogram):
+        label = f"{distance:>3}" if distance < HISTOGRAM_BINS else f">={distance}"
+        print(f"  {label:>5} {count:>8} {'#' * math.ceil(count * scale)}")
+
+
+def _comma_list(convert):
+    def parse(value):
+        return [convert(element) for element in value.split(",") if element]
+
+    return parse
+
+
+def run_sweep(args, dataset, cache):
+    methods = args.sweep_methods or [args.method]
+    for method in methods:
+        if method not in DEDUP_METHODS:
+            raise SystemExit(f"Unknown dedup method {method}")
+
+    hasher = ImageHasher(args.jobs, cache=cache, reduced_decode=not args.full_decode)
+    pre_len = len(dataset)
+    with tqdm(total=pre_len) as pbar:
+        results = sweep(
+            dataset,
+            hasher,
+            methods,
+            args.sweep,
+            progress=pbar,
+            **checker_options(args),
+        )
+
+    if cache is not None:
+        cache.close()
+
+    for result in results:
+        print(f"{result.name}: keeping {len(result.kept)} of {pre_len} images")
+
+    # with the lowest threshold the fewest images are dropped, so that
+    # histogram best shows the distribution of distances to unique images
+    for method in methods:
+        result = min(
+            (result for result in results if result.method == method),
+            key=lambda result: result.threshold,
+        )
+        print(f"Distance to nearest kept image for {result.name}")
+        _print_histogram(result.histogram)
+
+    if args.sweep_report is not None:
+        report = {
+            "dataset": str(args.dataset),
+            "images": pre_len,
+            "variants": [
+                {
+                    "method": result.method,
+                    "threshold": result.threshold,
+                    "kept": len(result.kept),
+                    "removed": pre_len - len(result.kept),
+                    "histogram": result.histogram.tolist(),
+                    "items": result.kept,
+                }
+                for result in results
+            ],
+        }
+        args.sweep_report.write_text(json.dumps(report, indent=2))
+
+    if args.save_variants:
+        for result in results:
+            output = args.output.with_name(f"{args.output.name}-{result.name}")
+            # Dataset.transform modifies in place, so transform a new dataset
+            variant = dm.Dataset.from_extractors(dataset)
+            variant.transform(SelectItemsTransform, keep=result.kept)
+            variant.export(str(output), dataset.format, save_media=args.save_images)
+            datumaro_fixup(output)
+
+
+def add_checker_arguments(parser):
+    """Options of the hash comparison methods"""
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        type=int,
+        default=DIFF_THRESHOLD,
+        help="Threshold of difference",
+    )
+    parser.add_argument(
+        "-r", "--ratio", type=float, default=DEFAULT_RATIO, help="Random ratio"
+    )
+    parser.add_argument(
+        "-b",
+        "--budget",
+        type=int,
+        default=DEFAULT_BUDGET,
+        help="Maximum number of comparisons per image (random)",
+    )
+    parser.add_argument(
+        "--reservoir",
+        type=int,
+        default=DEFAULT_RESERVOIR,
+        help="Number of kept images to sample comparisons from (random)",
+    )
+    parser.add_argument(
+        "-w",
+        "--window",
+        type=int,
+        default=DEFAULT_WINDOW,
+        help="Number of recently kept images to compare against (window)",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=DEFAULT_SEED, help="Random seed (random)"
+    )
+
+
+def checker_options(args):
+    return dict(
+        ratio=args.ratio,
+        budget=args.budget,
+        reservoir=args.reservoir,
+        window=args.window,
+        seed=args.seed,
+    )
+
+
+def parse_shard(spec):
+    """Parse an 'I/N' shard specification, shards are numbered from 0"""
+    index, _, count = spec.partition("/")
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise ValueError(f"Invalid shard {spec}, expected I/N") from None
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid shard {spec}, I should be in 0..N-1")
+    return index, count
+
+
+def shard_path(output, index, count):
+    return output.with_name(f"{output.name}-shard{index}of{count}.jsonl")
+
+
+def write_shard(
+    path,
+    items,
+    hasher,
+    algorithms,
+    shard,
+    dataset=None,
+    reduced_decode=True,
+    progress=None,
+):
+    """Hash a contiguous slice of the dataset items and write them to a JSON
+    lines file, a header line followed by [position, id, subset, hashes...]
+    for each item with hashes as hexadecimal strings.
+
+    The header records how the images were decoded, unique-merge refuses to
+    combine shards that were hashed differently."""
+    index, count = shard
+    total = len(items)
+    start, end = total * index // count, total * (index + 1) // count
+
+    header = dict(
+        dataset=dataset,
+        shard=index,
+        shards=count,
+        items=total,
+        start=start,
+        end=end,
+        algorithms=list(algorithms),
+        reduced_decode=reduced_decode,
+    )
+    # only the media of items in the slice is accessed
+    items = itertools.islice(items, start, end)
+
+    with open(path, "w") as shard_file:
+        shard_file.write(json.dumps(header) + "\n")
+        for position, (item, hashes) in enumerate(hasher.hash_items(items), start):
+            entry = [position, item.id, item.subset, *(f"{h:x}" for h in hashes)]
+            shard_file.write(json.dumps(entry) + "\n")
+            if progress is not None:
+                progress.update()
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -111,51 +1489,384 @@ def main():
     parser.add_argument(
         "-m",
         "--method",
-        choices=["sequential", "random", "exhaustive"],
+        choices=[*DEDUP_METHODS, "cluster", "annotations", "embedding"],
         default="sequential",
         help="amount of effort spent to look for possible duplicates",
     )
     parser.add_argument(
-        "-t",
-        "--threshold",
+        "-k",
+        "--keep",
+        choices=KEEP_POLICIES,
+        default="first",
+        help="Image kept from each cluster of near-duplicates (cluster)",
+    )
+    parser.add_argument(
+        "--iou",
+        type=float,
+        default=IOU_THRESHOLD,
+        help="Minimum overlap of boxes with the same label (annotations)",
+    )
+    parser.add_argument(
+        "--distance",
+        type=float,
+        default=EMBEDDING_DISTANCE,
+        help="Maximum cosine distance between similar images (embedding)",
+    )
+    parser.add_argument(
+        "--embedding-cache-file",
+        type=Path,
+        default=DEFAULT_EMBEDDING_CACHE_FILE,
+        help=f"""Persistent image embedding cache (defaults to
+        {DEFAULT_EMBEDDING_CACHE_FILE})""",
+    )
+    parser.add_argument(
+        "--annotations-first",
+        action="store_true",
+        help="""Drop frames with the same annotations as the previous frame
+        before hashing the remaining images""",
+    )
+    add_checker_arguments(parser)
+    parser.add_argument(
+        "-j",
+        "--jobs",
         type=int,
-        default=DIFF_THRESHOLD,
-        help="Threshold of difference",
+        default=1,
+        help="Number of parallel processes used to compute image hashes",
     )
     parser.add_argument(
-        "-r", "--ratio", type=float, default=DEFAULT_RATIO, help="Random ratio"
+        "--cache-file",
+        type=Path,
+        default=DEFAULT_CACHE_FILE,
+        help=f"Persistent image hash cache (defaults to {DEFAULT_CACHE_FILE})",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not use or update the persistent image hash cache",
+    )
+    parser.add_argument(
+        "--full-decode",
+        action="store_true",
+        help="Hash full resolution images instead of a reduced resolution decode",
+    )
+    parser.add_argument(
+        "--cascade",
+        metavar="STAGES",
+        help="""Comma separated hash[:threshold] stages, the first (cheap) hash
+        finds candidate duplicates which have to be confirmed by all following
+        hashes, e.g. dhash:16,phash:10,colorhash:4 [ahash, dhash, phash, whash,
+        colorhash] (defaults to phash:<threshold>)""",
+    )
+    parser.add_argument(
+        "--partition-by",
+        metavar="KEY",
+        help="""Deduplicate partitions of the dataset independently and in
+        parallel (-j), partitions are by 'subset', item id 'prefix', or the
+        value of an item attribute 'attr:NAME'""",
+    )
+    parser.add_argument(
+        "--reference-index",
+        type=Path,
+        help="""Also remove images that are similar to an image in this hash
+        index, the index is created when it does not exist""",
+    )
+    parser.add_argument(
+        "--update-reference",
+        action="store_true",
+        help="Append the hashes of the unique images to the reference index",
+    )
+    parser.add_argument(
+        "--no-output",
+        action="store_true",
+        help="Do not save the deduplicated dataset (i.e. when only building an index)",
     )
     parser.add_argument(
         "--save-images",
         action="store_true",
         help="Copy images instead of only references for filtered dataset",
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help=f"""Read and write items incrementally, memory use does not grow
+        with the size of the dataset (supports {', '.join(STREAM_METHODS)}).
+        The items are read once to find the subsets and once more for each
+        subset, so without the hash cache every image is hashed repeatedly""",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=Path,
+        help="""Record the hashes of processed images in this file (defaults
+        to <output>.checkpoint.jsonl), it is removed after a successful run""",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run from the images in the checkpoint",
+    )
+    parser.add_argument(
+        "--shard",
+        metavar="I/N",
+        help="""Only hash the I-th of N slices of the dataset (counting from 0)
+        and write the hashes to <output>-shard<I>of<N>.jsonl, the shards are
+        deduplicated with tpod-unique-merge""",
+    )
+    parser.add_argument(
+        "--sweep",
+        metavar="THRESHOLDS",
+        type=_comma_list(int),
+        help="Hash once and report results for comma separated thresholds",
+    )
+    parser.add_argument(
+        "--sweep-methods",
+        metavar="METHODS",
+        type=_comma_list(str),
+        help="Comma separated comparison methods to sweep (defaults to --method)",
+    )
+    parser.add_argument(
+        "--sweep-report",
+        type=Path,
+        help="Write kept items, counts, and distance histograms as JSON",
+    )
+    parser.add_argument(
+        "--save-variants",
+        action="store_true",
+        help="Save each sweep variant as <output>-<method>-t<threshold>",
+    )
     parser.add_argument("dataset", type=Path, help="Input dataset")
 
     args = parser.parse_args()
 
+    if args.stream:
+        if args.method not in STREAM_METHODS:
+            parser.error(f"--stream requires one of {', '.join(STREAM_METHODS)}")
+        if args.cascade and "," in args.cascade:
+            parser.error("--stream only supports a single hash algorithm")
+        if args.sweep or args.shard or args.partition_by or args.resume:
+            parser.error(
+                "--stream does not support --sweep, --shard, --partition-by, "
+                "or --resume"
+            )
+        if args.update_reference:
+            parser.error("--stream does not support --update-reference")
+
     datumaro_fixup(args.dataset)
-    dataset = dm.Dataset.import_from(str(args.dataset))
+    dataset = import_dataset(args.dataset, stream=args.stream)
 
-    pre_len = len(dataset)
-    with tqdm(total=pre_len) as pbar:
-        dataset = dataset.transform(
-            DedupTransform,
-            dedup_method=args.method,
-            threshold=args.threshold,
-            ratio=args.ratio,
-            progress=pbar,
+    cache = None if args.no_cache else HashCache(args.cache_file)
+
+    if args.sweep and args.shard:
+        parser.error("--sweep does not support --shard")
+
+    if args.sweep:
+        if args.cascade:
+            parser.error("--sweep does not support a --cascade of hashes")
+        run_sweep(args, dataset, cache)
+        return
+
+    try:
+        cascade = parse_cascade(args.cascade or "phash", args.threshold)
+        key = partition_key(args.partition_by) if args.partition_by else None
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    if args.shard:
+        try:
+            shard = parse_shard(args.shard)
+        except ValueError as exc:
+            parser.error(str(exc))
+
+        algorithms = [algorithm for algorithm, _ in cascade]
+        hasher = ImageHasher(
+            args.jobs,
+            cache=cache,
+            reduced_decode=not args.full_decode,
+            algorithms=algorithms,
+        )
+        path = shard_path(args.output, *shard)
+        with tqdm() as pbar:
+            write_shard(
+                path,
+                dataset,
+                hasher,
+                algorithms,
+                shard,
+                dataset=str(args.dataset),
+                reduced_decode=not args.full_decode,
+                progress=pbar,
+            )
+        if cache is not None:
+            cache.close()
+        print(f"Wrote {pbar.n} image hashes to {path}")
+        return
+
+    if args.method in ["annotations", "embedding"] and args.reference_index:
+        parser.error(f"{args.method} method does not support --reference-index")
+    if args.method == "embedding" and key is not None:
+        parser.error("embedding method does not support --partition-by")
+    if args.method == "cluster" and (key is not None or args.reference_index):
+        parser.error(
+            "cluster method does not support --partition-by or --reference-index"
         )
 
-        # the transform is lazily executed when we look at the data items, in
-        # this case calling len() actually triggers processing all transforms
-        cur_len = len(dataset)
+    reference = None
+    if args.reference_index is not None:
+        if key is not None:
+            parser.error("--reference-index does not support --partition-by")
+        try:
+            reference = ReferenceIndex(
+                args.reference_index, cascade[0][0], not args.full_decode
+            )
+        except ValueError as exc:
+            parser.error(str(exc))
+        if reference.algorithm not in [algorithm for algorithm, _ in cascade]:
+            parser.error(
+                f"{args.reference_index} contains {reference.algorithm} hashes,"
+                " which are not part of the --cascade"
+            )
+        # like shards, hashes of reduced and full decodes are not comparable
+        if reference.reduced_decode not in (None, not args.full_decode):
+            decode = "reduced" if reference.reduced_decode else "full"
+            parser.error(
+                f"{args.reference_index} contains hashes of {decode} resolution"
+                " decodes, use the same --full-decode setting"
+            )
+    elif args.update_reference:
+        parser.error("--update-reference requires a --reference-index")
+
+    options = checker_options(args)
+
+    # hashes of processed items are checkpointed to be able to --resume, the
+    # checkpoint grows with the dataset so it is not used when streaming
+    checkpoint = None
+    if args.method in [*DEDUP_METHODS, "cluster"] and key is None:
+        algorithms = [algorithm for algorithm, _ in cascade]
+        hasher = ImageHasher(
+            args.jobs,
+            cache=cache,
+            reduced_decode=not args.full_decode,
+            algorithms=algorithms,
+        )
+    if args.method in [*DEDUP_METHODS, "cluster"] and key is None and not args.stream:
+        config = dict(
+            dataset=str(args.dataset.resolve()),
+            algorithms=algorithms,
+            reduced_decode=not args.full_decode,
+        )
+        try:
+            checkpoint = Checkpoint(
+                args.checkpoint or checkpoint_path(args.output),
+                config,
+                resume=args.resume,
+            )
+        except ValueError as exc:
+            parser.error(str(exc))
+        if len(checkpoint):
+            print(f"Resuming after {len(checkpoint)} checkpointed images")
+        hasher = CheckpointHasher(hasher, checkpoint)
+    elif args.resume:
+        parser.error(f"--resume is not supported by {args.partition_by or args.method}")
+
+    # a stream dataset is read again by every len(), so only count it once
+    pre_len = total = len(dataset)
+    if args.annotations_first and args.method != "annotations":
+        dataset = dataset.transform(AnnotationDedupTransform, iou=args.iou)
+        # counting the remaining items applies the annotation-only pass
+        total = len(dataset)
+
+    with tqdm(total=total) as pbar:
+        if args.method == "annotations":
+            dataset = dataset.transform(
+                AnnotationDedupTransform, iou=args.iou, progress=pbar
+            )
+        elif args.method == "embedding":
+            try:
+                embedder = ImageEmbedder(
+                    cache=None if args.no_cache else args.embedding_cache_file,
+                    reduced_decode=not args.full_decode,
+                )
+            except ImportError as exc:
+                parser.error(str(exc))
+            dataset = dataset.transform(
+                EmbeddingDedupTransform,
+                distance=args.distance,
+                seed=args.seed,
+                embedder=embedder,
+                progress=pbar,
+            )
+        elif key is not None:
+            kept = partitioned_dedup(
+                dataset,
+                key,
+                args.method,
+                cascade,
+                jobs=args.jobs,
+                checker_options=options,
+                cache=cache,
+                reduced_decode=not args.full_decode,
+                progress=pbar,
+            )
+            dataset = dataset.transform(SelectItemsTransform, keep=kept)
+        elif args.method == "cluster":
+            kept = cluster_dedup(
+                dataset,
+                hasher,
+                cascade,
+                args.keep,
+                jobs=args.jobs,
+                reduced_decode=not args.full_decode,
+                progress=pbar,
+            )
+            dataset = dataset.transform(SelectItemsTransform, keep=kept)
+        else:
+            dataset = dataset.transform(
+                DedupTransform,
+                dedup_method=args.method,
+                cascade=cascade,
+                reference=reference,
+                update_reference=args.update_reference,
+                hasher=hasher,
+                progress=pbar,
+                **options,
+            )
+
+        if args.stream:
+            # a stream dataset is processed again on every pass over the
+            # items, so the transforms only run while saving. Datumaro makes
+            # one pass to find the subset names and one for each subset, the
+            # hash cache avoids hashing the images again on later passes
+            if not args.no_output:
+                dataset.save(str(args.output), save_media=args.save_images)
+                datumaro_fixup(args.output)
+        else:
+            # the transform is lazily executed when we look at the data items,
+            # in this case calling len() actually triggers processing all
+            # transforms
+            cur_len = len(dataset)
+
+    if cache is not None:
+        cache.close()
+
+    if args.stream:
+        print(f"Processed {pre_len} images, saved unique images to {args.output}")
+        return
+
     print(
         f"Removed {pre_len - cur_len} similar images, leaving {cur_len} unique images"
     )
 
-    dataset.save(str(args.output), save_media=args.save_images)
-    datumaro_fixup(args.output)
+    if not args.no_output:
+        dataset.save(str(args.output), save_media=args.save_images)
+        datumaro_fixup(args.output)
+
+    # the kept hashes are only added to the index once the run is complete,
+    # an interrupted run that is resumed would otherwise match its own images
+    if reference is not None:
+        reference.flush()
+        print(f"Reference index {args.reference_index} has {len(reference)} hashes")
+
+    if checkpoint is not None:
+        checkpoint.remove()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+#
+# SPDX-FileCopyrightText: 2024 Carnegie Mellon University
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+"""Remove similar frames based on image hashes from tpod-unique --shard runs
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+from pathlib import Path
+
+import datumaro as dm
+from tqdm import tqdm
+
+from .unique import (
+    DEDUP_METHODS,
+    IOU_THRESHOLD,
+    KEEP_POLICIES,
+    AnnotationDedupTransform,
+    DedupTransform,
+    SelectItemsTransform,
+    add_checker_arguments,
+    checker_options,
+    cluster_dedup,
+    parse_cascade,
+)
+from .utils import datumaro_fixup
+
+
+class PrecomputedHasher:
+    """Looks up the hashes of dataset items in a mapping of (id, subset)
+    keys, a drop-in replacement for ImageHasher"""
+
+    def __init__(self, hashes):
+        self._hashes = hashes
+
+    def hash_items(self, items):
+        for item in items:
+            try:
+                hashes = self._hashes[item.id, item.subset]
+            except KeyError:
+                raise KeyError(
+                    f"No hashes for item {item.id} ({item.subset})"
+                ) from None
+            yield item, hashes
+
+
+def read_shards(paths):
+    """Read the headers and hashes of a complete set of shard files, returns
+    the hash algorithms and a mapping of (id, subset) to a tuple of hashes"""
+    headers, hashes = {}, {}
+    for path in paths:
+        with open(path) as shard_file:
+            header = json.loads(shard_file.readline())
+            headers[header["shard"]] = header
+            for line in shard_file:
+                _, item_id, subset, *item_hashes = json.loads(line)
+                hashes[item_id, subset] = tuple(int(h, 16) for h in item_hashes)
+
+    first = next(iter(headers.values()))
+    for header in headers.values():
+        for field in ["shards", "items", "algorithms", "reduced_decode"]:
+            if header[field] != first[field]:
+                raise ValueError(f"Shards have a different {field}")
+
+    missing = set(range(first["shards"])) - set(headers)
+    if missing or len(paths) != first["shards"]:
+        raise ValueError(
+            f"Expected {first['shards']} different shards, missing {sorted(missing)}"
+        )
+    if len(hashes) != first["items"]:
+        raise ValueError(f"Expected {first['items']} items, found {len(hashes)}")
+
+    return first["algorithms"], hashes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-o", "--output", type=Path, default="unique", help="Output dataset"
+    )
+    parser.add_argument(
+        "-m",
+        "--method",
+        choices=[*DEDUP_METHODS, "cluster"],
+        default="sequential",
+        help="amount of effort spent to look for possible duplicates",
+    )
+    parser.add_argument(
+        "-k",
+        "--keep",
+        choices=KEEP_POLICIES,
+        default="first",
+        help="Image kept from each cluster of near-duplicates (cluster)",
+    )
+    add_checker_arguments(parser)
+    parser.add_argument(
+        "--cascade",
+        metavar="STAGES",
+        help="""Comma separated hash[:threshold] stages, only hashes that are
+        in the shard files can be used (defaults to all hashes in the shard
+        files with the same threshold)""",
+    )
+    parser.add_argument(
+        "--annotations-first",
+        action="store_true",
+        help="""Drop frames with the same annotations as the previous frame
+        before comparing image hashes""",
+    )
+    parser.add_argument(
+        "--iou",
+        type=float,
+        default=IOU_THRESHOLD,
+        help="Minimum overlap of boxes with the same label (--annotations-first)",
+    )
+    parser.add_argument(
+        "--save-images",
+        action="store_true",
+        help="Copy images instead of only references for filtered dataset",
+    )
+    parser.add_argument("dataset", type=Path, help="Input dataset")
+    parser.add_argument(
+        "shards", type=Path, nargs="+", help="Shard files from tpod-unique --shard"
+    )
+    args = parser.parse_args()
+
+    try:
+        algorithms, hashes = read_shards(args.shards)
+        cascade = parse_cascade(args.cascade or ",".join(algorithms), args.threshold)
+    except (OSError, ValueError) as exc:
+        parser.error(str(exc))
+
+    # reorder the stored hashes to match the stages of the cascade
+    try:
+        stages = [algorithms.index(algorithm) for algorithm, _ in cascade]
+    except ValueError:
+        parser.error(f"Shards only contain {','.join(algorithms)} hashes")
+    hashes = {
+        key: tuple(item_hashes[stage] for stage in stages)
+        for key, item_hashes in hashes.items()
+    }
+    hasher = PrecomputedHasher(hashes)
+
+    datumaro_fixup(args.dataset)
+    dataset = dm.Dataset.import_from(str(args.dataset))
+
+    pre_len = len(dataset)
+    if pre_len != len(hashes):
+        parser.error(f"Shards contain {len(hashes)} of {pre_len} dataset items")
+
+    if args.annotations_first:
+        dataset = dataset.transform(AnnotationDedupTransform, iou=args.iou)
+
+    with tqdm(total=len(dataset)) as pbar:
+        if args.method == "cluster":
+            kept = cluster_dedup(dataset, hasher, cascade, args.keep, progress=pbar)
+            dataset = dataset.transform(SelectItemsTransform, keep=kept)
+        else:
+            dataset = dataset.transform(
+                DedupTransform,
+                dedup_method=args.method,
+                cascade=cascade,
+                hasher=hasher,
+                progress=pbar,
+                **checker_options(args),
+            )
+        cur_len = len(dataset)
+
+    print(
+        f"Removed {pre_len - cur_len} similar images, leaving {cur_len} unique images"
+    )
+
+    dataset.save(str(args.output), save_media=args.save_images)
+    datumaro_fixup(args.output)
+
+
+if __name__ == "__main__":
+    main()
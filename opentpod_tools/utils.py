@@ -4,6 +4,7 @@
 import contextlib
 from pathlib import Path
 
+import datumaro as dm
 from datumaro.plugins.data_formats.datumaro.format import DatumaroPath
 
 
@@ -15,3 +16,18 @@ def datumaro_fixup(path: Path) -> None:
     for media_path in [DatumaroPath.IMAGES_DIR, DatumaroPath.VIDEO_DIR]:
         with contextlib.suppress(FileNotFoundError, OSError):
             path.joinpath(media_path).rmdir()
+
+
+def import_dataset(path: Path, stream: bool = False) -> dm.Dataset:
+    """Import a dataset, a stream dataset does not load all items in memory
+    but reads them from the source whenever it is iterated, and is saved
+    incrementally. Format detection parses entire annotation files, so a
+    stream dataset is always imported as Datumaro, the format tpod tools save."""
+    if not stream:
+        return dm.Dataset.import_from(str(path))
+
+    try:
+        from datumaro.components.dataset import StreamDataset
+    except ImportError:
+        raise SystemExit("Streaming requires a newer version of Datumaro") from None
+    return StreamDataset.import_from(str(path), "datumaro")
@@ -0,0 +1,11 @@
+# SPDX-FileCopyrightText: 2024 Carnegie Mellon University
+# SPDX-License-Identifier: Apache-2.0
+
+"""XDG base directories, without dependencies so that every tool can use it"""
+
+import os
+from pathlib import Path
+
+XDG_CACHE_DIR = (
+    Path(os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))) / "opentpod-tools"
+)
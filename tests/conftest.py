@@ -0,0 +1,54 @@
+# SPDX-FileCopyrightText: 2024 Carnegie Mellon University
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import pytest
+
+
+@pytest.fixture
+def noisy_frames():
+    """Build items with random images, every `repeat` consecutive frames are
+    equal"""
+    np = pytest.importorskip("numpy")
+    dm = pytest.importorskip("datumaro")
+
+    def build(count, repeat=3):
+        rng = np.random.default_rng(0)
+        items = []
+        for i in range(count):
+            if i % repeat == 0:
+                pixels = rng.integers(0, 256, (48, 64, 3), dtype=np.uint8)
+            media = dm.Image.from_numpy(pixels.astype(np.float32))
+            items.append(dm.DatasetItem(id=str(i), media=media))
+        return items
+
+    return build
+
+
+@pytest.fixture
+def export_frames():
+    """Save items as a Datumaro dataset, including the images"""
+    dm = pytest.importorskip("datumaro")
+
+    def export(path, items, categories=None):
+        dataset = dm.Dataset.from_iterable(
+            items, categories=categories, media_type=dm.Image
+        )
+        dataset.export(str(path), "datumaro", save_media=True)
+
+    return export
+
+
+@pytest.fixture
+def hashed_batches(monkeypatch):
+    """Sizes of the batches of images that are hashed during the test"""
+    unique = pytest.importorskip("opentpod_tools.unique")
+    batches = []
+    hash_image_sources = unique._hash_image_sources
+
+    def counting_hash_image_sources(sources, *args, **kwargs):
+        batches.append(len(sources))
+        return hash_image_sources(sources, *args, **kwargs)
+
+    monkeypatch.setattr(unique, "_hash_image_sources", counting_hash_image_sources)
+    return batches
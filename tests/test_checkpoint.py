@@ -0,0 +1,38 @@
+# SPDX-FileCopyrightText: 2024 Carnegie Mellon University
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import pytest
+
+from opentpod_tools.checkpoint import Checkpoint
+
+
+def test_checkpoint_resume(tmp_path):
+    path = tmp_path / "run.checkpoint.jsonl"
+    config = dict(dataset="filtered", algorithms=("phash",))
+
+    checkpoint = Checkpoint(path, config)
+    checkpoint.put(("frame_0", "default"), ["ff00"])
+    checkpoint.put(("frame_1", "default"), None)
+    checkpoint.close()
+
+    # a run that was killed while writing an entry
+    with path.open("a") as partial:
+        partial.write('["frame_2", "def')
+
+    checkpoint = Checkpoint(path, config, resume=True)
+    assert len(checkpoint) == 2
+    assert checkpoint.get(("frame_0", "default")) == ["ff00"]
+    assert ("frame_1", "default") in checkpoint
+    assert ("frame_2", "default") not in checkpoint
+
+    checkpoint.put(("frame_2", "default"), [])
+    checkpoint.close()
+    assert len(Checkpoint(path, config, resume=True)) == 3
+
+    with pytest.raises(ValueError):
+        Checkpoint(path, dict(config, dataset="other"), resume=True)
+
+    checkpoint = Checkpoint(path, config)
+    checkpoint.remove()
+    assert not path.exists()
@@ -0,0 +1,324 @@
+# SPDX-FileCopyrightText: 2024 Carnegie Mellon University
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import hashlib
+import io
+import itertools
+import json
+import re
+import threading
+import zipfile
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("configargparse")
+pytest.importorskip("requests")
+
+from opentpod_tools import download  # noqa: E402
+
+
+def make_zip():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        archive.writestr("annotations/default.json", "{}")
+    return buffer.getvalue()
+
+
+class FakeCVAT(BaseHTTPRequestHandler):
+    """Prepares each export for a few polls before it can be downloaded"""
+
+    polls = 2
+    payload = make_zip()
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split("?")[0]
+        with server.lock:
+            server.clients.add(self.client_address)
+
+        if not path.endswith("/dataset"):
+            id_ = int(path.rsplit("/", 1)[1])
+            body = json.dumps({"updated_date": server.updated[id_]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        with server.lock:
+            server.requests[path] += 1
+            count = server.requests[path]
+            if count == 1:
+                server.exporting += 1
+                server.max_exporting = max(server.max_exporting, server.exporting)
+
+        if count <= self.polls:
+            self.send_response(202 if count == 1 else 201)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Length", str(len(self.payload)))
+        self.end_headers()
+        self.wfile.write(self.payload)
+        with server.lock:
+            server.exporting -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def serve(handler, **state):
+    """Run a local HTTP server with the handler in a background thread"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.url = f"http://127.0.0.1:{server.server_port}/"
+    vars(server).update(state)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def cvat_server():
+    with serve(
+        FakeCVAT,
+        lock=threading.Lock(),
+        requests=Counter(),
+        clients=set(),
+        updated={},
+        exporting=0,
+        max_exporting=0,
+    ) as server:
+        yield server
+
+
+def test_poll_delays():
+    delays = list(itertools.islice(download.poll_delays(1, 10, 2), 6))
+    assert delays == [1, 2, 4, 8, 10, 10]
+
+
+def test_download_datasets(cvat_server, tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(download, "poll_delays", lambda: itertools.repeat(0.01))
+    monkeypatch.setattr(
+        "sys.argv",
+        ["tpod-download", "--url", cvat_server.url]
+        + ["--max-concurrency", "2", "1", "2", "3", "4"],
+    )
+    download.main()
+
+    for id_ in range(1, 5):
+        assert (tmp_path / f"datumaro_task_{id_}" / "annotations").is_dir()
+        assert not (tmp_path / f"datumaro_task_{id_}.zip").exists()
+        assert cvat_server.requests[f"/api/tasks/{id_}/dataset"] == FakeCVAT.polls + 1
+    assert cvat_server.max_exporting == 2
+    # connections are reused by the download workers
+    assert len(cvat_server.clients) <= 2
+    assert "Downloaded 4 datasets" in capsys.readouterr().out
+
+
+def test_unzip_disk_usage(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    archive = tmp_path / "datumaro_task_1.zip"
+    archive.write_bytes(make_zip())
+
+    usage = download.DiskUsage()
+    usage.update(archive.stat().st_size)
+    download.unzip_dataset(archive, usage)
+
+    assert not archive.exists()
+    assert usage.current == 2  # the extracted "{}"
+    assert usage.peak == len(make_zip()) + 2
+
+
+class CorruptExport(FakeCVAT):
+    """Serves a broken archive for task 2"""
+
+    def do_GET(self):
+        # the handler serves all requests on a kept alive connection
+        broken = self.path.startswith("/api/tasks/2/")
+        self.payload = b"not a zip file" if broken else FakeCVAT.payload
+        super().do_GET()
+
+
+def test_download_failure_is_per_dataset(cvat_server, tmp_path, monkeypatch, capsys):
+    cvat_server.RequestHandlerClass = CorruptExport
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(download, "poll_delays", lambda: itertools.repeat(0.01))
+    monkeypatch.setattr(
+        "sys.argv",
+        ["tpod-download", "--url", cvat_server.url]
+        + ["--max-concurrency", "3", "1", "2", "3"],
+    )
+    download.main()
+
+    assert (tmp_path / "datumaro_task_1" / "annotations").is_dir()
+    assert (tmp_path / "datumaro_task_3" / "annotations").is_dir()
+    assert not (tmp_path / "datumaro_task_2").exists()
+    output = capsys.readouterr().out
+    assert "Failed unpacking dataset 2" in output
+    assert "Downloaded 2 datasets" in output
+
+
+class FlakyDownload(BaseHTTPRequestHandler):
+    """Serves an export that is ready for download, but drops the connection
+    halfway through the first response"""
+
+    payload = bytes(range(256)) * 1024
+    etag = '"export-1"'
+    supports_range = True
+
+    def do_GET(self):
+        server = self.server
+        server.ranges.append(self.headers.get("Range"))
+
+        start = 0
+        match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range") or "")
+        unchanged = self.headers.get("If-Range") in (None, self.etag)
+        if match is not None and unchanged and self.supports_range:
+            start = int(match[1])
+            self.send_response(206)
+            self.send_header(
+                "Content-Range",
+                f"bytes {start}-{len(self.payload) - 1}/{len(self.payload)}",
+            )
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("ETag", self.etag)
+        self.send_header("Content-Length", str(len(self.payload) - start))
+        self.end_headers()
+
+        data = self.payload[start:]
+        if len(server.ranges) == 1:
+            data = data[: len(data) // 2]
+            self.close_connection = True
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.mark.parametrize("supports_range", [True, False])
+def test_resume_download(tmp_path, monkeypatch, supports_range):
+    monkeypatch.setattr(FlakyDownload, "supports_range", supports_range)
+    output = tmp_path / "datumaro_task_1.zip"
+    # chunks smaller than the data sent before the connection is dropped
+    with serve(FlakyDownload, ranges=[]) as server:
+        received, _ = download.cvat_export_dataset(
+            (server.url, None), 1, output, "datumaro", chunk_size=4096
+        )
+
+    assert output.read_bytes() == FlakyDownload.payload
+    assert not download.part_path(output).exists()
+    assert not (tmp_path / "datumaro_task_1.zip.part.validator").exists()
+    half = len(FlakyDownload.payload) // 2
+    assert received == len(FlakyDownload.payload)
+    assert server.ranges == [None, f"bytes={half}-"]
+
+
+def test_resume_after_restart(tmp_path):
+    output = tmp_path / "datumaro_task_1.zip"
+    part = download.part_path(output)
+    part.write_bytes(FlakyDownload.payload[:1000])
+    (tmp_path / "datumaro_task_1.zip.part.validator").write_text(FlakyDownload.etag)
+
+    # a previous request means the connection is not dropped
+    with serve(FlakyDownload, ranges=[None]) as server:
+        received, _ = download.cvat_export_dataset(
+            (server.url, None), 1, output, "datumaro"
+        )
+
+    assert output.read_bytes() == FlakyDownload.payload
+    assert received == len(FlakyDownload.payload) - 1000
+    assert server.ranges == [None, "bytes=1000-"]
+
+
+@pytest.mark.parametrize("validator", ['"export-0"', None])
+def test_restart_changed_export(tmp_path, validator):
+    output = tmp_path / "datumaro_task_1.zip"
+    part = download.part_path(output)
+    part.write_bytes(b"previous export" * 100)
+    if validator is not None:
+        (tmp_path / "datumaro_task_1.zip.part.validator").write_text(validator)
+
+    with serve(FlakyDownload, ranges=[None]) as server:
+        received, _ = download.cvat_export_dataset(
+            (server.url, None), 1, output, "datumaro"
+        )
+
+    # the partial download of another export is replaced, not appended to
+    assert output.read_bytes() == FlakyDownload.payload
+    assert received == len(FlakyDownload.payload)
+    expected = "bytes=1500-" if validator is not None else None
+    assert server.ranges == [None, expected]
+
+
+class Unavailable(FlakyDownload):
+    """Fails the first request with a server error"""
+
+    def do_GET(self):
+        if not self.server.ranges:
+            self.server.ranges.append("503")
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        super().do_GET()
+
+
+def test_retry_server_error(tmp_path):
+    output = tmp_path / "datumaro_task_1.zip"
+    with serve(Unavailable, ranges=[]) as server:
+        session = download.make_session(pool_size=1, retries=1)
+        with session:
+            download.cvat_export_dataset(
+                (server.url, None), 1, output, "datumaro", session=session
+            )
+        assert server.ranges == ["503", None]
+
+    assert output.read_bytes() == FlakyDownload.payload
+
+
+def test_sync(cvat_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(download, "poll_delays", lambda: itertools.repeat(0.01))
+    monkeypatch.setattr(
+        "sys.argv", ["tpod-download", "--url", cvat_server.url, "--sync", "1", "2"]
+    )
+    cvat_server.updated.update({1: "2024-01-01T00:00:00Z", 2: "2024-01-01T00:00:00Z"})
+    download.main()
+
+    manifest = json.loads((tmp_path / download.DEFAULT_MANIFEST).read_text())
+    assert manifest["datumaro_task_2"]["updated_date"] == "2024-01-01T00:00:00Z"
+    assert (
+        manifest["datumaro_task_2"]["sha256"]
+        == hashlib.sha256(FakeCVAT.payload).hexdigest()
+    )
+
+    # only the changed task is exported again, and replaces the old dataset
+    stale = tmp_path / "datumaro_task_2" / "stale"
+    stale.touch()
+    cvat_server.updated[2] = "2024-02-01T00:00:00Z"
+    cvat_server.requests.clear()
+    download.main()
+
+    assert cvat_server.requests["/api/tasks/1/dataset"] == 0
+    assert cvat_server.requests["/api/tasks/2/dataset"] > 0
+    assert not stale.exists()
+    assert (tmp_path / "datumaro_task_2" / "annotations").is_dir()
+    manifest = json.loads((tmp_path / download.DEFAULT_MANIFEST).read_text())
+    assert manifest["datumaro_task_2"]["updated_date"] == "2024-02-01T00:00:00Z"
@@ -0,0 +1,122 @@
+# SPDX-FileCopyrightText: 2024 Carnegie Mellon University
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import tracemalloc
+
+import pytest
+
+np = pytest.importorskip("numpy")
+dm = pytest.importorskip("datumaro")
+
+from opentpod_tools import filter as tpod_filter  # noqa: E402
+from opentpod_tools.filter import (  # noqa: E402
+    AnnotationFilterTransform,
+    FilterRules,
+    attribute_equals,
+)
+
+
+def _dataset():
+    def box(occluded):
+        attributes = {} if occluded is None else {"occluded": occluded}
+        return dm.Bbox(0, 0, 10, 10, label=0, attributes=attributes)
+
+    return dm.Dataset.from_iterable(
+        [
+            dm.DatasetItem(id="visible", annotations=[box(False), box(True)]),
+            dm.DatasetItem(id="occluded", annotations=[box(True)]),
+            dm.DatasetItem(id="unknown", annotations=[box(None), box(False)]),
+            dm.DatasetItem(id="empty"),
+        ],
+        categories=["car"],
+    )
+
+
+def _items(dataset):
+    return [(item.id, item.annotations) for item in dataset]
+
+
+def test_native_filter_matches_xpath():
+    expected = _dataset().filter(
+        '/item/annotation[occluded="False"]', filter_annotations=True, remove_empty=True
+    )
+    expected = expected.filter("//*", filter_annotations=True, remove_empty=True)
+
+    result = _dataset().transform(
+        AnnotationFilterTransform, predicates=[attribute_equals("occluded", "False")]
+    )
+    assert _items(result) == _items(expected)
+    assert [item_id for item_id, _ in _items(result)] == ["visible", "unknown"]
+
+    # without predicates only the empty frames are removed
+    result = _dataset().transform(AnnotationFilterTransform)
+    assert len(result) == 3
+
+
+def test_filter_rules():
+    item = dm.DatasetItem(
+        id="frame",
+        media=dm.Image.from_numpy(np.zeros((100, 200, 3))),
+        annotations=[
+            dm.Bbox(0, 0, 5, 5, label=0),  # small and touching the edge
+            dm.Bbox(50, 50, 20, 10, label=1),
+            dm.Bbox(190, 50, 10, 10, label=0),  # touching the edge
+            dm.Bbox(50, 50, 30, 10, label=2),  # excluded label
+            dm.Label(0),  # rules on boxes do not apply
+        ],
+    )
+    rules = FilterRules(
+        dict(min_area=50, min_edge_distance=1, exclude_labels=["sign"]),
+        ["car", "person", "sign"],
+    )
+    assert rules.annotation_mask(item).tolist() == [False, True, False, False, True]
+
+    dataset = dm.Dataset.from_iterable([item], categories=["car", "person", "sign"])
+    dataset.transform(AnnotationFilterTransform, rules=dict(max_annotations=1))
+    assert len(dataset) == 0
+
+    with pytest.raises(ValueError):
+        FilterRules(dict(min_size=10))
+
+
+def _stream_filter_peak(tmp_path, monkeypatch, count):
+    items = [
+        dm.DatasetItem(
+            id=str(i),
+            annotations=[
+                dm.Bbox(0, 0, 10, 10, label=0, attributes={"occluded": i % 2 == 0})
+            ],
+        )
+        for i in range(count)
+    ]
+    source = tmp_path / f"input{count}"
+    dm.Dataset.from_iterable(items, categories=["car"]).export(str(source), "datumaro")
+
+    output = tmp_path / f"output{count}"
+    monkeypatch.setattr(
+        "sys.argv",
+        [
+            "tpod-filter",
+            "--filter-occluded",
+            "--stream",
+            "-o",
+            str(output),
+            str(source),
+        ],
+    )
+    tracemalloc.start()
+    try:
+        tpod_filter.main()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return len(dm.Dataset.import_from(str(output), "datumaro")), peak
+
+
+def test_stream_filter_memory_is_bounded(tmp_path, monkeypatch):
+    # import, filter and save all go through tpod-filter --stream
+    small_kept, small_peak = _stream_filter_peak(tmp_path, monkeypatch, 500)
+    large_kept, large_peak = _stream_filter_peak(tmp_path, monkeypatch, 5000)
+    assert (small_kept, large_kept) == (250, 2500)
+    assert large_peak < 1.5 * small_peak + 256 * 1024
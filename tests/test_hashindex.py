@@ -0,0 +1,156 @@
+# SPDX-FileCopyrightText: 2024 Carnegie Mellon University
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import random
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from opentpod_tools.hashindex import (  # noqa: E402
+    BKTree,
+    CosineLSHIndex,
+    HashArray,
+    ReferenceIndex,
+    hamming_distance,
+    popcount64,
+)
+
+
+def _near(rng, value, bits):
+    for bit in rng.sample(range(64), bits):
+        value ^= 1 << bit
+    return value
+
+
+def test_bktree_matches_linear_scan():
+    rng = random.Random(42)
+    seeds = [rng.getrandbits(64) for _ in range(20)]
+    hashes = [_near(rng, rng.choice(seeds), rng.randrange(12)) for _ in range(500)]
+
+    for radius in (-1, 0, 4, 9):
+        tree = BKTree(leaf_size=8)
+        kept_tree, kept_linear = [], []
+        for value in hashes:
+            if not tree.any_within(value, radius):
+                tree.add(value)
+                kept_tree.append(value)
+            if all(hamming_distance(value, other) > radius for other in kept_linear):
+                kept_linear.append(value)
+        assert kept_tree == kept_linear
+
+
+def test_bktree_find_within():
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(64) for _ in range(200)]
+    tree = BKTree(leaf_size=8)
+    for value in hashes:
+        tree.add(value)
+
+    query = _near(rng, hashes[17], 3)
+    expected = [i for i, h in enumerate(hashes) if hamming_distance(query, h) <= 20]
+    assert sorted(tree.find_within(query, 20)) == expected
+
+    distances = [hamming_distance(query, h) for h in hashes]
+    assert tree.nearest(query, 64) == min(distances) == 3
+    assert tree.nearest(rng.getrandbits(64), 0) is None
+
+
+def test_hash_array_distances():
+    rng = random.Random(1)
+    hashes = [rng.getrandbits(64) for _ in range(100)] + [2**64 - 1, 0]
+    array = HashArray(capacity=4)
+    for value in hashes:
+        array.append(value)
+
+    query = rng.getrandbits(64)
+    expected = [hamming_distance(query, h) for h in hashes]
+    assert array.distances(query).tolist() == expected
+    assert popcount64(np.array([2**64 - 1], dtype=np.uint64)).tolist() == [64]
+    assert array.any_within(query, min(expected))
+    assert not array.any_within(query, min(expected) - 1)
+
+
+def test_reference_index(tmp_path):
+    rng = random.Random(2)
+    hashes = [rng.getrandbits(64) for _ in range(100)]
+    index = ReferenceIndex(tmp_path / "reference.hidx", "dhash")
+    for value in hashes:
+        index.append(value)
+    assert not index.any_within(hashes[0], 0)
+    index.flush()
+
+    index = ReferenceIndex(tmp_path / "reference.hidx", reduced_decode=False)
+    assert index.algorithm == "dhash" and len(index) == len(hashes)
+    assert index.reduced_decode is True
+    query = rng.getrandbits(64)
+    nearest = min(hamming_distance(query, h) for h in hashes)
+    assert index.any_within(query, nearest)
+    assert not index.any_within(query, nearest - 1)
+
+    # indexes written before the decode was recorded in the header
+    (tmp_path / "old.hidx").write_bytes(b"TPODHIDXphash".ljust(32, b"\0"))
+    index = ReferenceIndex(tmp_path / "old.hidx", "dhash", reduced_decode=False)
+    assert index.algorithm == "phash" and index.reduced_decode is None
+
+    (tmp_path / "invalid.hidx").write_bytes(b"invalid")
+    with pytest.raises(ValueError):
+        ReferenceIndex(tmp_path / "invalid.hidx")
+
+
+def test_bktree_from_array():
+    rng = random.Random(4)
+    seeds = [rng.getrandbits(64) for _ in range(10)]
+    hashes = [_near(rng, rng.choice(seeds), rng.randrange(8)) for _ in range(2000)]
+    hashes += hashes[:50]
+    tree = BKTree.from_array(np.array(hashes, dtype=np.uint64), leaf_size=16)
+    assert len(tree) == len(hashes)
+
+    for _ in range(50):
+        query = _near(rng, rng.choice(seeds), rng.randrange(12))
+        expected = [i for i, h in enumerate(hashes) if hamming_distance(query, h) <= 6]
+        assert sorted(tree.find_within(query, 6)) == expected
+
+
+def test_reference_index_matches_linear_scan(tmp_path):
+    rng = random.Random(5)
+    seeds = [rng.getrandbits(64) for _ in range(20)]
+    hashes = [_near(rng, rng.choice(seeds), rng.randrange(12)) for _ in range(3000)]
+    index = ReferenceIndex(tmp_path / "reference.hidx", "dhash")
+    for value in hashes[:2500]:
+        index.append(value)
+    index.flush()
+
+    def check(stored):
+        for _ in range(100):
+            query = _near(rng, rng.choice(seeds), rng.randrange(16))
+            for radius in (0, 3, 8):
+                expected = any(hamming_distance(query, h) <= radius for h in stored)
+                assert index.any_within(query, radius) == expected
+
+    check(hashes[:2500])
+
+    # hashes flushed after the tree was built are found as well
+    for value in hashes[2500:]:
+        index.append(value)
+    index.flush()
+    check(hashes)
+
+
+def test_cosine_lsh_index():
+    rng = np.random.default_rng(3)
+    vectors = rng.standard_normal((200, 64))
+    index = CosineLSHIndex(64, seed=0)
+    for vector in vectors:
+        index.add(vector)
+    assert len(index) == len(vectors)
+
+    # a slightly perturbed vector shares a bucket with the original
+    query = vectors[42] + 0.05 * rng.standard_normal(64)
+    expected = 1 - query @ vectors[42] / np.linalg.norm(query) / np.linalg.norm(
+        vectors[42]
+    )
+    assert index.nearest(query) == pytest.approx(expected, abs=1e-5)
+    assert index.any_within(query, 0.01)
+    assert not index.any_within(rng.standard_normal(64), 0.01)
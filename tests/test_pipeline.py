@@ -0,0 +1,44 @@
+# SPDX-FileCopyrightText: 2024 Carnegie Mellon University
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("imagehash")
+dm = pytest.importorskip("datumaro")
+
+from opentpod_tools import pipeline  # noqa: E402
+
+
+def test_pipeline_hashes_once(
+    tmp_path, monkeypatch, capsys, noisy_frames, export_frames, hashed_batches
+):
+    items = [
+        item.wrap(annotations=[dm.Bbox(4, 4, 16, 16, label=0)])
+        for item in noisy_frames(30)
+    ]
+    export_frames(tmp_path / "input", items, categories=["object"])
+
+    monkeypatch.setattr(
+        "sys.argv",
+        [
+            "tpod-pipeline",
+            "--no-cache",
+            "--split",
+            "train:0.5",
+            "--split",
+            "val:0.5",
+            "-o",
+            str(tmp_path / "output"),
+            str(tmp_path / "input"),
+        ],
+    )
+    pipeline.main()
+
+    assert sum(hashed_batches) == 30
+    assert "Kept 10 of 30 images (5 train, 5 val)" in capsys.readouterr().out
+
+    output = dm.Dataset.import_from(str(tmp_path / "output"), "datumaro")
+    assert len(output) == 10
+    assert sorted(int(item.id) for item in output) == list(range(0, 30, 3))
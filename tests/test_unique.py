@@ -0,0 +1,470 @@
+# SPDX-FileCopyrightText: 2024 Carnegie Mellon University
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+np = pytest.importorskip("numpy")
+imagehash = pytest.importorskip("imagehash")
+dm = pytest.importorskip("datumaro")
+
+from PIL import Image  # noqa: E402
+
+from opentpod_tools import unique  # noqa: E402
+from opentpod_tools.hashcache import HashCache  # noqa: E402
+from opentpod_tools.hashindex import ReferenceIndex, hash_to_int  # noqa: E402
+from opentpod_tools.unique import (  # noqa: E402
+    AnnotationDedupTransform,
+    CascadeChecker,
+    DedupTransform,
+    EmbeddingDedupTransform,
+    ImageEmbedder,
+    ImageHasher,
+    RandomChecker,
+    WindowChecker,
+    _hash_image_sources,
+    _thumbnail,
+    cluster_dedup,
+    make_checker,
+    parse_cascade,
+    partition_key,
+    partitioned_dedup,
+    phash_batch,
+    shard_path,
+    write_shard,
+)
+from opentpod_tools.unique_merge import read_shards  # noqa: E402
+
+
+def test_phash_batch_matches_imagehash():
+    rng = np.random.default_rng(0)
+    images = [
+        Image.fromarray(rng.integers(0, 256, (120, 160, 3), dtype=np.uint8))
+        for _ in range(50)
+    ]
+    images.append(Image.new("RGB", (64, 48), (10, 10, 10)))
+
+    hashes = phash_batch(np.stack([_thumbnail(image) for image in images]))
+    expected = [hash_to_int(imagehash.phash(image)) for image in images]
+    assert [int(image_hash) for image_hash in hashes] == expected
+
+
+def _frames(seed, count):
+    rng = np.random.default_rng(seed)
+    base = int(rng.integers(0, 2**63))
+    frames = []
+    for _ in range(count):
+        if rng.random() < 0.1:
+            base = int(rng.integers(0, 2**63))
+        frames.append(base ^ (1 << int(rng.integers(0, 64))))
+    return frames
+
+
+def _dedup(checker, frames):
+    kept = []
+    for frame in frames:
+        if not checker.is_duplicate(frame):
+            checker.add(frame)
+            kept.append(frame)
+    return kept
+
+
+def test_random_checker_is_seeded_and_bounded():
+    frames = _frames(0, 2000)
+    first = _dedup(RandomChecker(10, budget=8, reservoir=16, seed=1), frames)
+    second = _dedup(RandomChecker(10, budget=8, reservoir=16, seed=1), frames)
+    assert first == second
+
+    checker = RandomChecker(10, budget=8, reservoir=16, seed=1)
+    _dedup(checker, frames)
+    assert len(checker._reservoir) <= 16
+
+
+def test_window_checker():
+    assert _dedup(WindowChecker(10, 2), [0, 1, 2**40 - 1, 3, 2**40 - 2]) == [
+        0,
+        2**40 - 1,
+    ]
+    assert _dedup(WindowChecker(10, 1), [0, 2**40 - 1, 1]) == [0, 2**40 - 1, 1]
+
+
+def test_cascade():
+    cascade = parse_cascade("dhash:16,phash", threshold=4)
+    assert cascade == [("dhash", 16), ("phash", 4)]
+
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, (48, 64, 3), dtype=np.uint8)
+    hasher = ImageHasher(algorithms=["dhash", "phash"])
+    item = dm.DatasetItem(id="0", media=dm.Image.from_numpy(pixels))
+    [(_, hashes)] = hasher.hash_items([item])
+    image = Image.fromarray(pixels[:, :, ::-1])  # Datumaro pixels are BGR
+    assert hashes == (
+        hash_to_int(imagehash.dhash(image)),
+        hash_to_int(imagehash.phash(image)),
+    )
+
+    # the second stage rejects candidates found with the first hash
+    checker = CascadeChecker(make_checker("exhaustive", 16), [4])
+    checker.add((0, 0))
+    assert checker.is_duplicate((0b111, 0b111))
+    assert not checker.is_duplicate((0b111, 0b11111))
+    assert not checker.is_duplicate((2**20 - 1, 0))
+
+
+def test_color_hash_keeps_grayscale_hashes(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, (16, 16, 3), dtype=np.uint8)
+    path = str(tmp_path / "frame.jpg")
+    Image.fromarray(pixels).resize((256, 256), Image.BILINEAR).save(path)
+
+    modes = []
+    open_reduced = unique._open_reduced
+
+    def recording_open_reduced(path, mode, *args):
+        modes.append(mode)
+        return open_reduced(path, mode, *args)
+
+    monkeypatch.setattr(unique, "_open_reduced", recording_open_reduced)
+
+    # the decode for colorhash does not change the other hashes, which are
+    # always computed from a grayscale decode
+    [grayscale] = _hash_image_sources([path], ["dhash", "phash"])
+    [cascade] = _hash_image_sources([path], ["dhash", "phash", "colorhash"])
+    assert cascade[:2] == grayscale
+    assert modes == ["L", "RGB", "L"]
+
+
+class _RecordingPool(ProcessPoolExecutor):
+    submitted = 0
+
+    def submit(self, *args, **kwargs):
+        type(self).submitted += 1
+        return super().submit(*args, **kwargs)
+
+
+def test_dedup_transform_uses_worker_pool(monkeypatch, noisy_frames):
+    monkeypatch.setattr(unique, "ProcessPoolExecutor", _RecordingPool)
+
+    def kept(jobs):
+        dataset = dm.Dataset.from_iterable(noisy_frames(30))
+        dataset.transform(DedupTransform, jobs=jobs, batch_size=4)
+        return [item.id for item in dataset]
+
+    assert kept(1) == [str(i) for i in range(0, 30, 3)]
+    assert _RecordingPool.submitted == 0
+    assert kept(2) == kept(1)
+    # 30 images in batches of 4
+    assert _RecordingPool.submitted == 8
+
+
+def test_dedup_transform_hashes_in_batches(noisy_frames, hashed_batches):
+    dataset = dm.Dataset.from_iterable(noisy_frames(30))
+    dataset.transform(DedupTransform, batch_size=4)
+    assert len(dataset) == 10
+    assert hashed_batches == [4] * 7 + [2]
+
+
+def test_partitioned_dedup(tmp_path, noisy_frames):
+    items = []
+    for i, item in enumerate(noisy_frames(12)):
+        path = tmp_path / f"{i}.png"
+        Image.fromarray(item.media.data.astype(np.uint8)).save(path)
+        subset = "a" if i < 6 else "b"
+        items.append(
+            dm.DatasetItem(
+                id=str(i), subset=subset, media=dm.Image.from_file(str(path))
+            )
+        )
+    # the first frame of b repeats the last frame of a, but partitions are
+    # deduplicated independently
+    items[6] = items[5].wrap(id="6", subset="b")
+
+    with HashCache(tmp_path / "cache.sqlite") as cache:
+        kept = partitioned_dedup(
+            items, partition_key("subset"), "sequential", [("phash", 10)], 2, {}, cache
+        )
+        assert sorted(kept, key=lambda k: int(k[0])) == [
+            ("0", "a"),
+            ("3", "a"),
+            ("6", "b"),
+            ("7", "b"),
+            ("9", "b"),
+        ]
+        # hashes computed by the workers were stored by this process
+        assert cache.get(str(tmp_path / "11.png"), "phash-draft") is not None
+
+
+def _run_unique(monkeypatch, *args):
+    monkeypatch.setattr("sys.argv", ["tpod-unique", "--no-cache", *args])
+    unique.main()
+
+
+def test_build_reference_index(
+    tmp_path, monkeypatch, capsys, noisy_frames, export_frames
+):
+    monkeypatch.chdir(tmp_path)
+    export_frames(tmp_path / "training", noisy_frames(12))
+    export_frames(tmp_path / "new", noisy_frames(6))
+
+    reference = ["--reference-index", "train.hidx"]
+    _run_unique(
+        monkeypatch, *reference, "--update-reference", "--no-output", "training"
+    )
+    assert len(ReferenceIndex(tmp_path / "train.hidx")) == 4
+
+    # the frames of the new dataset are all in the training set
+    capsys.readouterr()
+    _run_unique(monkeypatch, *reference, "--no-output", "new")
+    assert "Removed 6 similar images, leaving 0" in capsys.readouterr().out
+
+    # the index was built from reduced resolution decodes
+    with pytest.raises(SystemExit):
+        _run_unique(monkeypatch, *reference, "--full-decode", "--no-output", "new")
+    assert "reduced resolution decodes" in capsys.readouterr().err
+
+
+def test_dedup_transform_updates_reference_path(tmp_path, noisy_frames):
+    dataset = dm.Dataset.from_iterable(noisy_frames(12), media_type=dm.Image)
+    path = str(tmp_path / "frames.hidx")
+    dataset.transform(DedupTransform, reference=path, update_reference=True)
+    assert len(dataset) == 4
+    assert len(ReferenceIndex(path)) == 4
+
+
+def test_resume_with_update_reference(
+    tmp_path, monkeypatch, noisy_frames, export_frames
+):
+    monkeypatch.chdir(tmp_path)
+    export_frames(tmp_path / "frames", noisy_frames(30))
+
+    def run(name, *args):
+        reference = ["--reference-index", f"{name}.hidx", "--update-reference"]
+        _run_unique(monkeypatch, *reference, "-o", name, *args, "frames")
+        kept = [item.id for item in dm.Dataset.import_from(name)]
+        return kept, ReferenceIndex(f"{name}.hidx")
+
+    hash_items = ImageHasher.hash_items
+
+    def interrupted(self, items):
+        for count, result in enumerate(hash_items(self, items)):
+            if count == 16:
+                raise KeyboardInterrupt
+            yield result
+
+    with monkeypatch.context() as patched:
+        patched.setattr(ImageHasher, "hash_items", interrupted)
+        with pytest.raises(KeyboardInterrupt):
+            run("resumed")
+    assert len(ReferenceIndex("resumed.hidx")) == 0
+
+    kept, index = run("resumed", "--resume")
+    expected, expected_index = run("complete")
+    assert len(expected) == 10
+    assert kept == expected
+    assert list(index._hashes) == list(expected_index._hashes)
+
+
+def test_stream_dedup(
+    tmp_path, monkeypatch, capsys, noisy_frames, export_frames, hashed_batches
+):
+    # two subsets, Datumaro reads the stream once for the subset names and
+    # once more for each subset
+    items = [
+        item.wrap(subset="train" if i < 18 else "val")
+        for i, item in enumerate(noisy_frames(30))
+    ]
+    export_frames(tmp_path / "input", items)
+
+    monkeypatch.setattr(
+        "sys.argv",
+        [
+            "tpod-unique",
+            "--stream",
+            "-m",
+            "window",
+            "--cache-file",
+            str(tmp_path / "hashes.db"),
+            "-o",
+            str(tmp_path / "output"),
+            str(tmp_path / "input"),
+        ],
+    )
+    unique.main()
+
+    assert "Processed 30 images" in capsys.readouterr().out
+    # later passes find the hashes in the cache
+    assert sum(hashed_batches) == 30
+
+    output = dm.Dataset.import_from(str(tmp_path / "output"), "datumaro")
+    assert sorted(int(item.id) for item in output) == list(range(0, 30, 3))
+    assert {name: len(subset) for name, subset in output.subsets().items()} == {
+        "train": 6,
+        "val": 4,
+    }
+
+
+class _FixedHasher:
+    def __init__(self, hashes):
+        self._hashes = hashes
+
+    def hash_items(self, items):
+        return zip(items, self._hashes)
+
+
+def test_cluster_dedup_keep_policies():
+    rng = np.random.default_rng(0)
+    sharp = rng.integers(0, 256, (64, 64, 3), dtype=np.uint8).astype(np.float32)
+    blurry = np.full((64, 64, 3), 128, dtype=np.float32)
+    box = dm.Bbox(0, 0, 10, 10, label=0)
+
+    items = [
+        dm.DatasetItem(id="0", media=dm.Image.from_numpy(blurry)),
+        dm.DatasetItem(id="1", media=dm.Image.from_numpy(sharp), annotations=[box]),
+        dm.DatasetItem(id="2", media=dm.Image.from_numpy(blurry)),
+        dm.DatasetItem(id="3", media=dm.Image.from_numpy(blurry)),
+    ]
+    # 0-1-2 is a chain of near-duplicates, 3 is unique
+    hasher = _FixedHasher([(0,), (0b111,), (0b111111,), (2**64 - 1,)])
+    cascade = [("phash", 4)]
+
+    def kept(policy):
+        keys = cluster_dedup(items, hasher, cascade, policy)
+        return sorted(item_id for item_id, _ in keys)
+
+    assert kept("first") == ["0", "3"]
+    assert kept("annotations") == ["1", "3"]
+    assert kept("sharpness") == ["1", "3"]
+
+
+def test_annotation_dedup():
+    def frame(item_id, *boxes):
+        annotations = [dm.Bbox(x, 0, 10, 10, label=label) for x, label in boxes]
+        return dm.DatasetItem(id=item_id, annotations=annotations)
+
+    dataset = dm.Dataset.from_iterable(
+        [
+            frame("0", (0, 0), (50, 1)),
+            frame("1", (50, 1), (0.5, 0)),
+            frame("2", (0, 0)),
+            frame("3", (0, 1)),
+            frame("4", (5, 1)),
+            frame("5"),
+            frame("6"),
+        ],
+        categories=["a", "b"],
+    )
+    dataset.transform(AnnotationDedupTransform, iou=0.8)
+    assert [item.id for item in dataset] == ["0", "2", "3", "4", "5", "6"]
+
+
+class _MeanColorModel:
+    name = "mean-color"
+    dim = 3
+
+    def __call__(self, images):
+        return np.array(
+            [np.asarray(image, dtype=float).mean(axis=(0, 1)) for image in images]
+        )
+
+
+def test_embedding_dedup():
+    class RecordingModel(_MeanColorModel):
+        def __init__(self):
+            self.calls = []
+
+        def __call__(self, images):
+            self.calls.append(len(images))
+            return super().__call__(images)
+
+    colors = [(255, 0, 0), (250, 5, 0), (0, 255, 0), (255, 0, 0), (0, 0, 255)]
+    dataset = dm.Dataset.from_iterable(
+        [
+            dm.DatasetItem(
+                id=str(i), media=dm.Image.from_numpy(np.full((8, 8, 3), color))
+            )
+            for i, color in enumerate(colors)
+        ]
+    )
+    model = RecordingModel()
+    embedder = ImageEmbedder(batch_size=2, model=model)
+    dataset.transform(EmbeddingDedupTransform, distance=0.01, embedder=embedder)
+    assert [item.id for item in dataset] == ["0", "2", "4"]
+    # the images are run through the model in batches
+    assert model.calls == [2, 2, 1]
+
+
+def test_shards_roundtrip(tmp_path):
+    class IdHasher:
+        def hash_items(self, items):
+            for item in items:
+                yield item, (int(item.id), 2**64 - 1 - int(item.id))
+
+    items = [dm.DatasetItem(id=str(i)) for i in range(11)]
+    hasher = IdHasher()
+
+    paths = []
+    for shard in range(3):
+        path = shard_path(tmp_path / "unique", shard, 3)
+        write_shard(path, items, hasher, ["dhash", "phash"], (shard, 3))
+        paths.append(path)
+
+    algorithms, hashes = read_shards(paths)
+    assert algorithms == ["dhash", "phash"]
+    assert hashes == {(str(i), "default"): (i, 2**64 - 1 - i) for i in range(11)}
+
+    with pytest.raises(ValueError):
+        read_shards(paths[:2])
+
+    # shards hashed from full resolution images are not combined
+    write_shard(
+        paths[1], items, hasher, ["dhash", "phash"], (1, 3), reduced_decode=False
+    )
+    with pytest.raises(ValueError):
+        read_shards(paths)
+
+
+class _GeneratedFrames(dm.DatasetBase):
+    """Frames that are only created while iterating, like a stream dataset"""
+
+    def __init__(self, count):
+        super().__init__(length=count)
+        self._count = count
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield dm.DatasetItem(id=str(i))
+
+
+class _FrameHasher:
+    def hash_items(self, items):
+        for item in items:
+            # every three consecutive frames are identical
+            yield item, (int(item.id) // 3 * 0x9E3779B97F4A7C15 % 2**64,)
+
+
+def _peak_memory(count, method):
+    transform = DedupTransform(
+        _GeneratedFrames(count),
+        dedup_method=method,
+        window=16,
+        reservoir=64,
+        hasher=_FrameHasher(),
+    )
+    tracemalloc.start()
+    try:
+        kept = sum(1 for _ in transform)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return kept, peak
+
+
+@pytest.mark.parametrize("method", ["sequential", "window", "random"])
+def test_streaming_dedup_memory_is_bounded(method):
+    small_kept, small_peak = _peak_memory(2000, method)
+    large_kept, large_peak = _peak_memory(20000, method)
+    assert large_kept > 9 * small_kept
+    assert large_peak < 1.5 * small_peak + 64 * 1024